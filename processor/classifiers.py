@@ -1,18 +1,24 @@
+import hashlib
 import json
 import logging
 import os
 import pickle
-import shutil
-from typing import Dict, List
+import sqlite3
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import numpy as np
 import requests
-import tensorflow_hub as hub
-
-# loaded here because the non-english embeddings model needs it
-import tensorflow_text  # noqa: F401
+import scipy.sparse
 
 import processor.apiclient as apiclient
+import processor.embeddings_cache as embeddings_cache
+import processor.util as util
 from processor import base_dir
 
 logger = logging.getLogger(__name__)
@@ -32,22 +38,73 @@ VECTORIZER_TYPES = [VECTORIZER_TF_IDF, VECTORIZER_EMBEDDINGS]
 
 DEFAULT_MODEL_NAME = "usa"
 
+# keeps track of what we downloaded (and the ETag etc. the server sent), so we only download files that change
+DOWNLOAD_MANIFEST_FILENAME = "downloads.json"
+MODEL_DOWNLOAD_THREADS = int(os.environ.get("MODEL_DOWNLOAD_THREADS", 8))
+# mkstemp makes files only we can read, but downloaded files should get the usual permissions (so other users, like
+# the one the workers run as, can read them). Reading the umask means briefly changing it, so do it once at import
+# time, before any download threads exist.
+_umask = os.umask(0)
+os.umask(_umask)
+DOWNLOADED_FILE_MODE = 0o666 & ~_umask
+
 LANGUAGE_EN = "en"
 TFHUB_MODEL_PATH_EN = os.path.join(MODEL_DIR, "embeddings-en")
 LANGUAGE_KO = "ko"
 TFHUB_MODEL_PATH_MULTI = os.path.join(MODEL_DIR, "embeddings-multi")
 
+# how many stories to send through an embeddings model at once (bigger uses more memory)
+EMBEDDINGS_BATCH_SIZE = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", 64))
+# optionally only look at the start of long stories (0 means use the whole text)
+MAX_STORY_TEXT_CHARS = int(os.environ.get("MAX_STORY_TEXT_CHARS", 0))
+
+# loaded classifiers are kept around per worker process so we don't unpickle and load models on every task
+CLASSIFIER_CACHE_MAX_MB = int(os.environ.get("CLASSIFIER_CACHE_MAX_MB", 4096))
+# acts as an LRU, with the most recently used at the end
+_classifier_cache: OrderedDict = OrderedDict()
+_classifier_cache_lock = threading.Lock()
+# one per cache key, held while loading that classifier (so loading a slow one doesn't hold up the others)
+_classifier_load_locks: Dict[Tuple, threading.Lock] = {}
+
+# the embeddings models are big, so each one is loaded once per process and shared by every classifier that uses it
+# path -> (mtime when loaded, model)
+_embeddings_models: Dict[str, Tuple[int, Any]] = {}
+_embeddings_models_lock = threading.Lock()
+# path -> lock held while loading that model
+_embeddings_load_locks: Dict[str, threading.Lock] = {}
+
+# TF-IDF vectorizers are shared by the digest of their pickle file (weakly, so evicted classifiers free them up)
+_tfidf_vectorizers: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+_tfidf_vectorizers_lock = threading.Lock()
+# recently computed TF-IDF rows, keyed by (vectorizer digest, text hash)
+TFIDF_CACHE_SIZE = int(os.environ.get("TFIDF_CACHE_SIZE", 20000))
+_tfidf_rows: OrderedDict = OrderedDict()
+_tfidf_rows_lock = threading.Lock()
+
+# the model list is read on every task, so it is parsed once and indexed by id (until the file changes)
+MODEL_LIST_FILENAME = "language-models.json"
+# (path, mtime when loaded, model list, models by id)
+_model_list: Tuple[str, int, List[Dict], Dict[int, Dict]] = None
+_model_list_lock = threading.Lock()
+
 
 class Classifier:
     """
     This is a wrapper around all our classifiers, so the implementation details don't matter to the consumer. Based on
-    the model the project refers to, it decides how to load and run the associated models.
+    the model config, it decides how to load and run the associated models. These are shared by every project that
+    uses the same model (and language, for embeddings), so they don't hold on to any one project.
     """
 
-    def __init__(self, model_config: Dict, project: Dict):
+    def __init__(self, model_config: Dict, language: Optional[str]):
+        """
+        :param model_config: the model's entry from the model list
+        :param language: picks the embeddings model (only needed if the model uses embeddings)
+        """
         self.config = model_config
-        self.project = project
+        self.language = language
+        self.fingerprint = self._files_fingerprint()
         self._init()
+        self.estimated_size = self._estimated_size()
 
     def model_name(self) -> str:
         return self.config["filename_prefix"]
@@ -57,90 +114,117 @@ class Classifier:
             MODEL_DIR, self.config["filename_prefix"] + "_" + filename + ".p"
         )
 
+    def _files(self) -> List[str]:
+        """
+        All the files on disk this classifier is loaded from.
+        """
+        stages = ["1", "2"] if self.config["chained_models"] else ["1"]
+        files = []
+        for stage in stages:
+            files.append(self._path_to_file(stage + "_model"))
+            if self.config["vectorizer_type_" + stage] == VECTORIZER_TF_IDF:
+                files.append(self._path_to_file(stage + "_vectorizer"))
+            elif self.config["vectorizer_type_" + stage] == VECTORIZER_EMBEDDINGS:
+                files.append(_embeddings_model_path(self.language))
+        return files
+
+    def _files_fingerprint(self) -> Tuple:
+        """
+        Identifies the exact versions of the files on disk, so we can tell if `download_models` has replaced any of
+        them since this was loaded.
+        """
+        fingerprint = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+                fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                fingerprint.append((path, None, None))
+        return tuple(fingerprint)
+
+    def _estimated_size(self) -> int:
+        """
+        Rough guess of memory used, based on the size of the files on disk (in bytes). Embeddings models are shared
+        across classifiers (see `load_embeddings_model`), so they aren't counted here.
+        """
+        return sum(
+            os.path.getsize(path) for path in self._files() if os.path.isfile(path)
+        )
+
+    def _describe(self, project: Optional[Dict]) -> str:
+        # for error messages
+        if project is None:
+            return "Model {}".format(self.config["id"])
+        return "Model {} on project {}".format(self.config["id"], project["id"])
+
+    def is_stale(self) -> bool:
+        return self._files_fingerprint() != self.fingerprint
+
     def _init(self):
+        self._tfidf_digests = {}  # stage -> digest of the vectorizer pickle
+        self._embeddings_version = (
+            None  # which embeddings model the cached vectors have to come from
+        )
         # Classifier 1 is always defined
-        with open(self._path_to_file("1_model"), "rb") as m:  # load model
-            self._model_1 = pickle.load(m)
-        if self.config["vectorizer_type_1"] == VECTORIZER_TF_IDF:  # load vectorizer
-            with open(self._path_to_file("1_vectorizer"), "rb") as v:
-                self._vectorizer_1 = pickle.load(v)
-        elif self.config["vectorizer_type_1"] == VECTORIZER_EMBEDDINGS:
-            try:
-                model_path = (
-                    TFHUB_MODEL_PATH_EN
-                    if self.project["language"] == LANGUAGE_EN
-                    else TFHUB_MODEL_PATH_MULTI
-                )
-                if self.project["language"].lower() == LANGUAGE_EN:
-                    self._vectorizer_1 = hub.load(model_path)
-                elif self.project["language"].lower() == LANGUAGE_KO:
-                    self._vectorizer_1 = hub.load(model_path)
-                else:
-                    raise RuntimeError(
-                        "Unsupported embeddings language '{}' for project {}".format(
-                            self.project["language"], self.project["id"]
-                        )
+        self._model_1, self._vectorizer_1 = self._load_stage("1")
+        # Classifier 2 could also exist
+        if self.config["chained_models"]:
+            self._model_2, self._vectorizer_2 = self._load_stage("2")
+            if self._same_vectorizers():
+                # both stages turn text into the same vectors, so we only need to vectorize once when classifying
+                self._vectorizer_2 = self._vectorizer_1
+
+    def _same_vectorizers(self) -> bool:
+        # vectorizers are shared per process (embeddings by path, TF-IDF by the contents of the pickle)
+        return (
+            self.config["vectorizer_type_1"] == self.config["vectorizer_type_2"]
+        ) and (self._vectorizer_1 is self._vectorizer_2)
+
+    def _load_stage(self, stage: str) -> Tuple[Any, Any]:
+        with open(self._path_to_file(stage + "_model"), "rb") as m:  # load model
+            model = pickle.load(m)
+        vectorizer_type = self.config["vectorizer_type_" + stage]
+        if vectorizer_type == VECTORIZER_TF_IDF:  # load vectorizer
+            digest, vectorizer = load_tfidf_vectorizer(
+                self._path_to_file(stage + "_vectorizer")
+            )
+            self._tfidf_digests[stage] = digest
+        elif vectorizer_type == VECTORIZER_EMBEDDINGS:
+            if (self.language or "").lower() not in [LANGUAGE_EN, LANGUAGE_KO]:
+                raise RuntimeError(
+                    "Unsupported embeddings language '{}' for model {}".format(
+                        self.language, self.config["id"]
                     )
+                )
+            model_path = _embeddings_model_path(self.language)
+            try:
+                self._embeddings_version = embeddings_model_version(model_path)
+                vectorizer = load_embeddings_model(model_path)
             except OSError as ose:
                 # probably the cached SavedModel doesn't exist anymore
                 logger.error(ose)
                 raise RuntimeError(
-                    "Project {} - model {} - can't load _vectorizer_1 from {} - did you run /scripts/download-models.sh?".format(
-                        self.project["id"],
-                        self.project["language_model_id"],
+                    "Model {} - can't load _vectorizer_{} from {} - did you run /scripts/download-models.sh?".format(
+                        self.config["id"],
+                        stage,
                         model_path,
                     )
                 )
         else:
             raise RuntimeError(
-                "Unknown vectorizer 1 type '{}' for project {}".format(
-                    self.config["vectorizer_type_1"], self.project["id"]
+                "Unknown vectorizer {} type '{}' for model {}".format(
+                    stage, vectorizer_type, self.config["id"]
                 )
             )
-        # Classifier 2 could also exist
-        if self.config["chained_models"]:
-            with open(self._path_to_file("2_model"), "rb") as m:  # load model
-                self._model_2 = pickle.load(m)
-            if self.config["vectorizer_type_2"] == VECTORIZER_TF_IDF:  # load vectorizer
-                with open(self._path_to_file("2_vectorizer"), "rb") as v:
-                    self._vectorizer_2 = pickle.load(v)
-            elif self.config["vectorizer_type_2"] == VECTORIZER_EMBEDDINGS:
-                try:
-                    model_path = (
-                        TFHUB_MODEL_PATH_EN
-                        if self.project["language"] == LANGUAGE_EN
-                        else TFHUB_MODEL_PATH_MULTI
-                    )
-                    if self.project["language"].lower() == LANGUAGE_EN:
-                        self._vectorizer_2 = hub.load(model_path)
-                    elif self.project["language"].lower() == LANGUAGE_KO:
-                        self._vectorizer_2 = hub.load(model_path)
-                    else:
-                        raise RuntimeError(
-                            "Unsupported embeddings language '{}' for project {}".format(
-                                self.project["language"], self.project["id"]
-                            )
-                        )
-                except OSError:
-                    # probably the cached SavedModel doesn't exist anymore
-                    raise RuntimeError(
-                        "Project {} - model {} - can't load _vectorizer_2 from {} - did you run /scripts/download-models.sh?".format(
-                            self.project["id"],
-                            self.project["language_model_id"],
-                            model_path,
-                        )
-                    )
-            else:
-                raise RuntimeError(
-                    "Unknown vectorizer 2 type '{}' for project {}".format(
-                        self.config["vectorizer_type_2"], self.project["id"]
-                    )
-                )
+        return model, vectorizer
 
-    def classify(self, stories: List[Dict]) -> Dict[str, List[float]]:
+    def classify(
+        self, stories: List[Dict], project: Optional[Dict] = None
+    ) -> Dict[str, List[float]]:
         """
 
         :param stories:
+        :param project: the project these stories are being classified for (only used in error messages)
         :return: a dict with 3 entries:
                 * `model_1_scores`: scores from model 1 (None if only one model)
                 * `model_2_scores`: scores from model 2 (None if only one model)
@@ -154,25 +238,29 @@ class Classifier:
                 model_scores=[],
             )
 
-        story_texts = [s["story_text"] for s in stories]
+        story_texts = [_truncate(s["story_text"]) for s in stories]
 
         # Classifier 1 always exists (but only chained models have classifier_2
         # vectorize first (turn words/sentences into vectors)
         try:
             if self.config["vectorizer_type_1"] == VECTORIZER_TF_IDF:
-                vectorized_data_1 = self._vectorizer_1.transform(story_texts)
+                vectorized_data_1 = _tfidf_transform(
+                    self._vectorizer_1, self._tfidf_digests["1"], story_texts
+                )
             elif self.config["vectorizer_type_1"] == VECTORIZER_EMBEDDINGS:
-                vectorized_data_1 = self._vectorizer_1(story_texts)
+                vectorized_data_1 = _embed(
+                    self._vectorizer_1, self._embeddings_version, story_texts
+                )
             else:
                 raise RuntimeError(
-                    "Unknown vectorizer1 type of {} on project {}".format(
-                        self.config["vectorizer_type_1"], self.project["id"]
+                    "Unknown vectorizer1 type of {} for {}".format(
+                        self.config["vectorizer_type_1"], self._describe(project)
                     )
                 )
         except AttributeError as ae:
             logger.error(ae)
             raise RuntimeError(
-                "Project {} model missing vectorizer".format(self.project["id"])
+                "Missing vectorizer for {}".format(self._describe(project))
             )
 
         # now run model against vectors (turn vectors into probabilities)
@@ -184,8 +272,8 @@ class Classifier:
         except ValueError as ve:
             logger.exception(ve)
             raise RuntimeError(
-                "Model {} failed to run ({}/{})".format(
-                    self.config["id"],
+                "{} failed to run ({}/{})".format(
+                    self._describe(project),
                     self.config["model_1"],
                     self.config["vectorizer_type_1"],
                 )
@@ -197,14 +285,20 @@ class Classifier:
             )
 
         # Classifier 2 could also exist
-        if self.config["vectorizer_type_2"] == VECTORIZER_TF_IDF:
-            vectorized_data_2 = self._vectorizer_2.transform(story_texts)
+        if self._vectorizer_2 is self._vectorizer_1:
+            vectorized_data_2 = vectorized_data_1
+        elif self.config["vectorizer_type_2"] == VECTORIZER_TF_IDF:
+            vectorized_data_2 = _tfidf_transform(
+                self._vectorizer_2, self._tfidf_digests["2"], story_texts
+            )
         elif self.config["vectorizer_type_2"] == VECTORIZER_EMBEDDINGS:
-            vectorized_data_2 = self._vectorizer_2(story_texts)
+            vectorized_data_2 = _embed(
+                self._vectorizer_2, self._embeddings_version, story_texts
+            )
         else:
             raise RuntimeError(
-                "Unknown vectorizer2 type of {} on project {}".format(
-                    self.config["vectorizer_type_2"], self.project["id"]
+                "Unknown vectorizer2 type of {} for {}".format(
+                    self.config["vectorizer_type_2"], self._describe(project)
                 )
             )
 
@@ -217,8 +311,8 @@ class Classifier:
         except ValueError as ve:
             logger.exception(ve)
             raise RuntimeError(
-                "Model {} failed to run ({}/{})".format(
-                    self.config["id"],
+                "{} failed to run ({}/{})".format(
+                    self._describe(project),
                     self.config["model_2"],
                     self.config["vectorizer_type_2"],
                 )
@@ -233,16 +327,150 @@ class Classifier:
         )
 
 
+def _truncate(story_text: str) -> str:
+    if MAX_STORY_TEXT_CHARS and story_text and (len(story_text) > MAX_STORY_TEXT_CHARS):
+        return story_text[:MAX_STORY_TEXT_CHARS]
+    return story_text
+
+
+def _embed(
+    embeddings_model: Any, model_name: str, story_texts: List[str]
+) -> np.ndarray:
+    """
+    Run texts through the embeddings model in small batches, so a page of long stories doesn't cause a big memory
+    spike. Each text is embedded independently, so the results are the same as doing them all at once. Vectors we've
+    computed before are looked up in the on-disk embeddings cache instead of being run through the model again.
+    """
+    cache = embeddings_cache.get_cache()
+    vectors = [None] * len(story_texts)
+    if cache:
+        try:
+            vectors = cache.get_many(model_name, story_texts)
+        except sqlite3.Error as e:
+            # locked by another worker, disk full, corrupt... not worth failing classification over
+            logger.warning("Can't read from embeddings cache: {}".format(e))
+    missing_indexes = [idx for idx, v in enumerate(vectors) if v is None]
+    if missing_indexes:
+        missing_texts = [story_texts[idx] for idx in missing_indexes]
+        new_vectors = np.concatenate(
+            [
+                np.asarray(embeddings_model(batch))
+                for batch in util.chunks(missing_texts, EMBEDDINGS_BATCH_SIZE)
+            ]
+        )
+        if cache:
+            try:
+                cache.put_many(model_name, missing_texts, new_vectors)
+            except sqlite3.Error as e:
+                logger.warning("Can't save to embeddings cache: {}".format(e))
+        for idx, vector in zip(missing_indexes, new_vectors):
+            vectors[idx] = vector
+    return np.stack(vectors)
+
+
+def load_tfidf_vectorizer(path: str) -> Tuple[str, Any]:
+    """
+    Return the TF-IDF vectorizer pickled at this path (and the digest of the file). Many models ship identical
+    vectorizers, so these are shared by every classifier in this process that has one with the same contents.
+    :return: a (digest, vectorizer) tuple
+    """
+    digest = file_digest(path)
+    with _tfidf_vectorizers_lock:
+        vectorizer = _tfidf_vectorizers.get(digest)
+        if vectorizer is None:
+            with open(path, "rb") as v:
+                vectorizer = pickle.load(v)
+            _tfidf_vectorizers[digest] = vectorizer
+    return digest, vectorizer
+
+
+def _tfidf_transform(vectorizer: Any, digest: str, story_texts: List[str]) -> Any:
+    """
+    Turn texts into a sparse TF-IDF matrix, reusing rows we've already computed for the same text with the same
+    vectorizer (ie. stories that matched multiple projects).
+    """
+    keys = [(digest, embeddings_cache.text_hash(t)) for t in story_texts]
+    with _tfidf_rows_lock:
+        rows = [_tfidf_rows.get(k) for k in keys]
+    missing_indexes = [idx for idx, r in enumerate(rows) if r is None]
+    if missing_indexes:
+        new_matrix = vectorizer.transform([story_texts[idx] for idx in missing_indexes])
+        for row_idx, idx in enumerate(missing_indexes):
+            rows[idx] = new_matrix[row_idx]
+    with _tfidf_rows_lock:
+        for key, row in zip(keys, rows):
+            _tfidf_rows[key] = row
+            _tfidf_rows.move_to_end(key)
+        while len(_tfidf_rows) > TFIDF_CACHE_SIZE:
+            _tfidf_rows.popitem(last=False)
+    return scipy.sparse.vstack(rows, format="csr")
+
+
+def file_digest(path: str) -> str:
+    """
+    SHA-256 hex digest of a file's contents, read in chunks so big pickles don't need to fit in memory twice.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _embeddings_model_path(language: str) -> str:
+    return TFHUB_MODEL_PATH_EN if language == LANGUAGE_EN else TFHUB_MODEL_PATH_MULTI
+
+
+def embeddings_model_version(model_path: str) -> str:
+    """
+    Identifies the exact copy of an embeddings model on disk, for keying the embeddings cache. The name alone isn't
+    enough, because `download_models` can replace the model with a new version under the same name.
+    """
+    graph_path = os.path.join(model_path, "saved_model.pb")
+    stat = os.stat(graph_path if os.path.exists(graph_path) else model_path)
+    return "{}@{}-{}".format(
+        os.path.basename(model_path), stat.st_mtime_ns, stat.st_size
+    )
+
+
+def load_embeddings_model(model_path: str) -> Any:
+    """
+    Return the TF-Hub SavedModel at this path, loading it only the first time it is asked for in this process (or
+    again if the files on disk have been replaced since).
+    """
+    mtime = os.stat(model_path).st_mtime_ns
+    with _embeddings_models_lock:
+        cached = _embeddings_models.get(model_path)
+        if (cached is not None) and (cached[0] == mtime):
+            return cached[1]
+        load_lock = _embeddings_load_locks.setdefault(model_path, threading.Lock())
+    with load_lock:
+        # someone else might have loaded it while we were waiting
+        with _embeddings_models_lock:
+            cached = _embeddings_models.get(model_path)
+        if (cached is not None) and (cached[0] == mtime):
+            return cached[1]
+        logger.info("Loading embeddings model from {}".format(model_path))
+        # TensorFlow is slow to import and uses a lot of memory, so only import it once we really need it (this keeps
+        # fetchers and beat fast and small)
+        import tensorflow_hub as hub
+
+        # loaded here because the non-english embeddings model needs it
+        import tensorflow_text  # noqa: F401
+
+        model = hub.load(model_path)
+        with _embeddings_models_lock:
+            _embeddings_models[model_path] = (mtime, model)
+    return model
+
+
 def for_project(project: Dict) -> Classifier:
     """
-    This is a factory method to return a Classifer for the project based on the `language_model_id`
+    This is a factory method to return a Classifer for the project based on the `language_model_id`. Classifiers are
+    cached per process, so the models are only loaded from disk the first time (or after they are re-downloaded).
     """
-    model_list = get_model_list()
     try:
-        matching_models = [
-            m for m in model_list if int(m["id"]) == int(project["language_model_id"])
-        ]
-        model_config = matching_models[0]
+        model_config = _model_index()[int(project["language_model_id"])]
         logger.debug("Project {} - model {}".format(project["id"], model_config["id"]))
     except Exception as e:
         logger.exception(
@@ -255,7 +483,80 @@ def for_project(project: Dict) -> Classifier:
                 project["id"], project["language_model_id"], e
             )
         )
-    return Classifier(model_config, project)
+    try:
+        return _cached_classifier(model_config, project["language"])
+    except RuntimeError as e:
+        raise RuntimeError("Project {} - {}".format(project["id"], e))
+
+
+def _cached_classifier(model_config: Dict, language: Optional[str]) -> Classifier:
+    # embeddings models are picked based on the project language, so that has to be part of the key for them
+    uses_embeddings = VECTORIZER_EMBEDDINGS in [
+        model_config["vectorizer_type_1"],
+        model_config.get("vectorizer_type_2"),
+    ]
+    cache_key = (int(model_config["id"]), language if uses_embeddings else None)
+    with _classifier_cache_lock:
+        classifier = _fresh_cached_classifier(cache_key, model_config)
+        if classifier is not None:
+            return classifier
+        load_lock = _classifier_load_locks.setdefault(cache_key, threading.Lock())
+    # load it without holding up everyone else using the cache
+    with load_lock:
+        with _classifier_cache_lock:
+            # someone else might have loaded it while we were waiting
+            classifier = _fresh_cached_classifier(cache_key, model_config)
+        if classifier is not None:
+            return classifier
+        classifier = Classifier(model_config, cache_key[1])
+        with _classifier_cache_lock:
+            _classifier_cache[cache_key] = classifier
+            _classifier_cache.move_to_end(cache_key)
+            _evict_classifiers()
+    return classifier
+
+
+def _fresh_cached_classifier(
+    cache_key: Tuple, model_config: Dict
+) -> Optional[Classifier]:
+    """
+    The cached classifier for this key, unless it is out of date (in which case it's dropped). Call while holding
+    `_classifier_cache_lock`.
+    """
+    classifier = _classifier_cache.get(cache_key)
+    if classifier is None:
+        return None
+    if (classifier.config == model_config) and not classifier.is_stale():
+        _classifier_cache.move_to_end(cache_key)
+        return classifier
+    logger.info("Model {} changed - reloading it".format(model_config["id"]))
+    del _classifier_cache[cache_key]
+    return None
+
+
+def _evict_classifiers() -> None:
+    # drop least recently used classifiers until we are under budget (but always keep the one we just added)
+    max_bytes = CLASSIFIER_CACHE_MAX_MB * 1024 * 1024
+    while (len(_classifier_cache) > 1) and (
+        sum(c.estimated_size for c in _classifier_cache.values()) > max_bytes
+    ):
+        evicted_key, _ = _classifier_cache.popitem(last=False)
+        logger.info("Evicted model {} from classifier cache".format(evicted_key[0]))
+
+
+def clear_classifier_cache() -> None:
+    with _classifier_cache_lock:
+        _classifier_cache.clear()
+        _classifier_load_locks.clear()
+
+
+def clear_model_list_cache() -> None:
+    """
+    Forget the model list read from disk, so the next lookup re-reads the file.
+    """
+    global _model_list
+    with _model_list_lock:
+        _model_list = None
 
 
 def get_model_list() -> List[Dict]:
@@ -263,57 +564,164 @@ def get_model_list() -> List[Dict]:
     Get the locally cached list of models
     :return:
     """
-    with open(os.path.join(CONFIG_DIR, "language-models.json"), "r") as f:
-        return json.load(f)
+    return list(_load_model_list()[2])
+
+
+def _model_index() -> Dict[int, Dict]:
+    return _load_model_list()[3]
+
+
+def _load_model_list() -> Tuple[str, int, List[Dict], Dict[int, Dict]]:
+    """
+    Only re-read the model list file if it has changed since we last read it in this process.
+    """
+    global _model_list
+    path = os.path.join(CONFIG_DIR, MODEL_LIST_FILENAME)
+    mtime = os.stat(path).st_mtime_ns
+    with _model_list_lock:
+        if (
+            (_model_list is None)
+            or (_model_list[0] != path)
+            or (_model_list[1] != mtime)
+        ):
+            with open(path, "r") as f:
+                _model_list = _indexed_model_list(path, mtime, json.load(f))
+        return _model_list
+
+
+def _indexed_model_list(
+    path: str, mtime: int, model_list: List[Dict]
+) -> Tuple[str, int, List[Dict], Dict[int, Dict]]:
+    return path, mtime, model_list, {int(m["id"]): m for m in model_list}
 
 
 def update_model_list():
     """
     Fetch and save list of models from the central server.
     """
+    global _model_list
     model_list = apiclient.get_language_models_list()
     if len(model_list) == 0:
         raise RuntimeError("Fetched empty model list was empty - bailing unhappily")
-    with open(os.path.join(CONFIG_DIR, "language-models.json"), "w") as f:
-        json.dump(model_list, f)
+    path = os.path.join(CONFIG_DIR, MODEL_LIST_FILENAME)
+    with _model_list_lock:
+        with open(path, "w") as f:
+            json.dump(model_list, f)
+        # the mtime might not change if it is written twice quickly, so don't rely on it here
+        _model_list = _indexed_model_list(path, os.stat(path).st_mtime_ns, model_list)
     return model_list
 
 
 def download_models() -> bool:
     """
-    Models are stored centrally on the server. We need to retrieve and store them here.
+    Models are stored centrally on the server. We need to retrieve and store them here. Files that haven't changed on
+    the server since we last downloaded them are skipped.
     Returns success or failure bool - if False you probably want to suspend what you were doing and bail out
     """
     try:
         model_list = update_model_list()
+        manifest = _load_download_manifest()
         logger.info("Downloading models:")
+        downloads = []
         for m in model_list:
             logger.info("  {} - {}".format(m["id"], m["name"]))
             for u in m["model_1_files"]:
-                _download_file(u, MODEL_DIR, m["filename_prefix"] + "_1")
+                downloads.append((u, m["filename_prefix"] + "_1"))
             for u in m["model_2_files"]:
-                _download_file(u, MODEL_DIR, m["filename_prefix"] + "_2")
+                downloads.append((u, m["filename_prefix"] + "_2"))
+        with ThreadPoolExecutor(max_workers=MODEL_DOWNLOAD_THREADS) as executor:
+            futures = [
+                executor.submit(_download_file, u, MODEL_DIR, prefix, manifest)
+                for u, prefix in downloads
+            ]
+            results = [f.result() for f in futures]  # raises if any download failed
+        changed_count = 0
+        for filename, entry, changed in results:
+            manifest[filename] = entry
+            changed_count += 1 if changed else 0
+        _save_download_manifest(manifest)
+        logger.info(
+            "  {} of {} model files changed".format(changed_count, len(results))
+        )
+        if changed_count > 0:
+            clear_classifier_cache()
         return True
     except Exception as e:
         logger.error(f"Couldn't get the models - bailing out cowardly {e}")
     return False
 
 
-def _download_file(url: str, dest_dir: str, prefix: str):
+def _load_download_manifest() -> Dict[str, Dict]:
+    try:
+        with open(os.path.join(MODEL_DIR, DOWNLOAD_MANIFEST_FILENAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_download_manifest(manifest: Dict[str, Dict]) -> None:
+    fd, temp_path = tempfile.mkstemp(dir=MODEL_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.chmod(temp_path, DOWNLOADED_FILE_MODE)
+    os.replace(temp_path, os.path.join(MODEL_DIR, DOWNLOAD_MANIFEST_FILENAME))
+
+
+def _download_file(
+    url: str, dest_dir: str, prefix: str, manifest: Dict[str, Dict]
+) -> Tuple[str, Dict, bool]:
     """
     This expects the files to either end with "_model.p" or "_vectorizer.p". It renames them here so that
-    there is less of a convention that needs to be maintained on the central server.
+    there is less of a convention that needs to be maintained on the central server. Files are downloaded to a temp
+    file and then renamed into place, so a worker loading a model never sees a half-written pickle.
     :param url:
     :param dest_dir:
     :param prefix:
-    :return:
+    :param manifest: what we know about files we downloaded before (by local filename)
+    :return: a tuple of the local filename, its updated manifest entry, and if the file contents changed
     """
     # https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests
     url_parts = urlparse(url)
     local_filename = url_parts.path.split("/")[-1]
     filename_parts = local_filename.split("_")
     extra_safe_filename = prefix + "_" + filename_parts[-1]
+    local_path = os.path.join(dest_dir, extra_safe_filename)
+    previous = manifest.get(extra_safe_filename, {})
+    have_previous = os.path.exists(local_path) and (previous.get("url") == url)
+    # only ask for the file if it changed since we last downloaded it from the same place
+    headers = {}
+    if have_previous and previous.get("etag"):
+        headers["If-None-Match"] = previous["etag"]
+    if have_previous and previous.get("last_modified"):
+        headers["If-Modified-Since"] = previous["last_modified"]
+    with requests.get(url, stream=True, headers=headers, timeout=60) as r:
+        if r.status_code == 304:
+            logger.info("    {} unchanged".format(extra_safe_filename))
+            return extra_safe_filename, previous, False
+        r.raise_for_status()
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=dest_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in r.iter_content(chunk_size=1024 * 1024):
+                    digest.update(block)
+                    f.write(block)
+            entry = dict(
+                url=url,
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+                sha256=digest.hexdigest(),
+            )
+            # the server might not support conditional requests, so check if the contents actually changed
+            if have_previous and (previous.get("sha256") == entry["sha256"]):
+                os.remove(temp_path)
+                logger.info("    {} unchanged".format(extra_safe_filename))
+                return extra_safe_filename, entry, False
+            os.chmod(temp_path, DOWNLOADED_FILE_MODE)
+            os.replace(temp_path, local_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
     logger.info("    to {}".format(extra_safe_filename))
-    with requests.get(url, stream=True) as r:
-        with open(os.path.join(dest_dir, extra_safe_filename), "wb") as f:
-            shutil.copyfileobj(r.raw, f)
+    return extra_safe_filename, entry, True
@@ -1,24 +1,59 @@
-from typing import Optional
+import os
+from typing import Any, Optional
 
-from sqlalchemy import Engine, create_engine
+from sqlalchemy import Engine, create_engine, make_url
 from sqlalchemy.orm import sessionmaker
 
 from processor import SQLALCHEMY_DATABASE_URI
 
 DEFAULT_ENGINE = "sqlite:///data.db"
 
-# act like singletons
+# act like singletons (one per process - see `_check_for_fork`)
 _engine: Optional[Engine] = None
 _Session_Maker: Optional[sessionmaker] = None
+_engine_pid: Optional[int] = None
+# the async ones are only made if someone asks for them (they need asyncpg installed)
+_async_engine: Optional[Any] = None
+_Async_Session_Maker: Optional[Any] = None
+_async_engine_pid: Optional[int] = None
+
+# the process that imported this module; anything else is a forked child (a Pool worker, a celery worker...)
+_parent_pid = os.getpid()
+
+# max connections is pool_size + max_overflow, but max_overflow ones don't sleep after being used
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 20))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 30))
+# forked children usually do one thing at a time, and there can be lots of them, so they get a small pool each
+CHILD_POOL_SIZE = int(os.environ.get("DB_CHILD_POOL_SIZE", 2))
+CHILD_MAX_OVERFLOW = int(os.environ.get("DB_CHILD_MAX_OVERFLOW", 3))
+
+# async code can share one engine across lots of tasks in a single event loop, so it has its own pool size
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", 10))
+ASYNC_MAX_OVERFLOW = int(os.environ.get("ASYNC_MAX_OVERFLOW", 10))
+
+
+def _check_for_fork() -> None:
+    """
+    If we've been forked since the engine was made then its pooled connections belong to the parent process. Using
+    them from here too leads to corrupted connections and EOF errors, so forget about them (without closing them,
+    which would break the parent) and let this process make its own engine.
+    """
+    global _engine, _Session_Maker
+    if (_engine is not None) and (_engine_pid != os.getpid()):
+        _engine.dispose(close=False)
+        _engine = None
+        _Session_Maker = None
 
 
 def _get_engine(reset_pool: bool = False) -> Engine:
     """
-    :param force_reset: close the engine and make a new one; helpful for when you know you'll need to get an engine
-    a *long* time after it was initially created... which is leading to EOF errors
+    :param reset_pool: close the pooled connections and make new ones; helpful for when you know you'll need to get an
+    engine a *long* time after it was initially created. Not needed after forking - each process gets its own engine
+    automatically.
     :return:
     """
-    global _engine
+    global _engine, _engine_pid
+    _check_for_fork()
     if _engine:
         if reset_pool:
             _engine.dispose()  # this closes the existing pool and automatically recreates it
@@ -29,21 +64,22 @@ def _get_engine(reset_pool: bool = False) -> Engine:
     if db_uri is DEFAULT_ENGINE:
         _engine = create_engine(db_uri)  # use defaults (probably in test mode)
     else:
+        is_child = os.getpid() != _parent_pid
         _engine = create_engine(
             db_uri,
-            # max connections is pool_size + max_overflow, but max_overflow ones don't sleep after
-            # being used
-            pool_size=20,
-            max_overflow=30,
+            pool_size=CHILD_POOL_SIZE if is_child else POOL_SIZE,
+            max_overflow=CHILD_MAX_OVERFLOW if is_child else MAX_OVERFLOW,
             # make sure connections actually work when we first make them, rather than when we
             # first use them
             pool_pre_ping=True,
         )
+    _engine_pid = os.getpid()
     return _engine
 
 
 def _get_session_maker(reset_pool: bool = False) -> sessionmaker:
     global _Session_Maker
+    _check_for_fork()
     if _Session_Maker is None:
         _Session_Maker = sessionmaker(bind=_get_engine(reset_pool))
     return _Session_Maker
@@ -51,3 +87,63 @@ def _get_session_maker(reset_pool: bool = False) -> sessionmaker:
 
 def get_session_maker(reset_pool: bool = False) -> sessionmaker:
     return _get_session_maker(reset_pool)
+
+
+def _async_db_uri(db_uri: str) -> str:
+    """
+    Switch the database driver to an asyncio one (asyncpg for Postgres, aiosqlite for SQLite).
+    """
+    url = make_url(db_uri)
+    if url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+    elif url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    else:
+        raise RuntimeError(
+            "No async driver configured for {}".format(url.get_backend_name())
+        )
+    return url.render_as_string(hide_password=False)
+
+
+def get_async_session_maker() -> Any:
+    """
+    An `async_sessionmaker` for code running in an asyncio event loop, so it can do database work while waiting on
+    the network in the same process. This is optional - it needs `asyncpg` (or `aiosqlite` in test mode) installed,
+    and everything else keeps using the regular `get_session_maker`.
+    :return: an `async_sessionmaker` whose sessions are used like `async with Session() as session: ...`
+    """
+    global _async_engine, _Async_Session_Maker, _async_engine_pid
+    # like the sync one, each process needs its own (see `_check_for_fork`)
+    if (_Async_Session_Maker is not None) and (_async_engine_pid == os.getpid()):
+        return _Async_Session_Maker
+    if _async_engine is not None:
+        # inherited from the parent, so drop its pooled connections without closing the sockets it is still using
+        _async_engine.sync_engine.dispose(close=False)
+        _async_engine = None
+        _Async_Session_Maker = None
+    # only import these when asked for, so the async drivers aren't needed otherwise
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    db_uri = _async_db_uri(
+        DEFAULT_ENGINE if SQLALCHEMY_DATABASE_URI is None else SQLALCHEMY_DATABASE_URI
+    )
+    try:
+        if db_uri.startswith("sqlite"):
+            _async_engine = create_async_engine(db_uri)  # probably in test mode
+        else:
+            _async_engine = create_async_engine(
+                db_uri,
+                pool_size=ASYNC_POOL_SIZE,
+                max_overflow=ASYNC_MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+    except ImportError as e:
+        raise RuntimeError(
+            "Can't make async database engine - is the async driver installed? ({})".format(
+                e
+            )
+        )
+    # don't expire objects on commit, because lazy-loading attributes afterwards isn't allowed in async code
+    _Async_Session_Maker = async_sessionmaker(_async_engine, expire_on_commit=False)
+    _async_engine_pid = os.getpid()
+    return _Async_Session_Maker
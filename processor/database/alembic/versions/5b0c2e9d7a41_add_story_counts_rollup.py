@@ -0,0 +1,46 @@
+"""add story counts rollup
+
+Revision ID: 5b0c2e9d7a41
+Revises: 79a4a6f3ae5e
+Create Date: 2026-10-18 04:41:52.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0c2e9d7a41'
+down_revision = '79a4a6f3ae5e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'story_counts',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('project_id', sa.Integer),
+        sa.Column('source', sa.String),
+        sa.Column('published_day', sa.Date),
+        sa.Column('processed_day', sa.Date),
+        sa.Column('above_threshold', sa.Boolean),
+        sa.Column('posted', sa.Boolean),
+        sa.Column('score_bucket', sa.Float),
+        sa.Column('stories', sa.Integer),
+    )
+    op.create_index('story_counts_project_published_day', 'story_counts', ['project_id', 'published_day'])
+    # fill it in from what we have so far (after this stories_db keeps it up to date)
+    op.execute("""
+        INSERT INTO story_counts
+            (project_id, source, published_day, processed_day, above_threshold, posted, score_bucket, stories)
+        SELECT project_id, source, published_date::date, processed_date::date, above_threshold,
+            posted_date is not Null, ROUND(CAST(model_score as numeric), 1), count(1)
+        FROM stories
+        GROUP BY 1, 2, 3, 4, 5, 6, 7
+    """)
+
+
+def downgrade():
+    op.drop_index('story_counts_project_published_day', table_name='story_counts')
+    op.drop_table('story_counts')
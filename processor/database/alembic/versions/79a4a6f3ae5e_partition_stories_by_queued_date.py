@@ -0,0 +1,120 @@
+"""partition stories by queued date
+
+Revision ID: 79a4a6f3ae5e
+Revises: 036b1381b853
+Create Date: 2026-10-18 04:02:11.531874
+
+"""
+import datetime as dt
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '79a4a6f3ae5e'
+down_revision = '036b1381b853'
+branch_labels = None
+depends_on = None
+
+# keep in sync with processor.database.stories_db
+WEEKS_AHEAD = 4
+
+COLUMNS = """
+    project_id integer,
+    model_id integer,
+    model_score double precision,
+    published_date timestamp without time zone,
+    processed_date timestamp without time zone,
+    posted_date timestamp without time zone,
+    above_threshold boolean,
+    model_1_score double precision,
+    model_2_score double precision,
+    source character varying,
+    url character varying,
+    normalized_url character varying
+"""
+COLUMN_NAMES = "id, project_id, model_id, model_score, published_date, queued_date, processed_date, posted_date, " \
+               "above_threshold, model_1_score, model_2_score, source, url, normalized_url"
+
+INDEXES = [
+    ('stories_processed_above_threshold_true', ['processed_date', 'above_threshold'], '(above_threshold = true)'),
+    ('stories_project_model_score', ['project_id', 'model_score'], None),
+    ('stories_project_posted_date', ['project_id', 'posted_date'], None),
+    ('stories_source_processed_date', ['processed_date', 'source'], None),
+    ('stories_source_published_date', ['published_date', 'source'], None),
+]
+
+
+def _create_indexes():
+    for name, columns, where in INDEXES:
+        op.create_index(name, 'stories', columns, unique=False, postgresql_where=where)
+
+
+def upgrade():
+    # Postgres can't have a unique index across partitions unless it includes the partition key, so the two
+    # uniqueness constraints turn into plain indexes (add_stories checks for existing URLs before inserting)
+    op.rename_table('stories', 'stories_unpartitioned')
+    op.drop_constraint('uq_stories_project_id_url', 'stories_unpartitioned')
+    op.drop_constraint('uq_stories_project_id_normalized_url', 'stories_unpartitioned')
+    for name, _, _ in INDEXES:
+        op.drop_index(name, table_name='stories_unpartitioned')
+    op.execute("ALTER TABLE stories_unpartitioned RENAME CONSTRAINT stories_pkey TO stories_unpartitioned_pkey")
+    op.execute("""
+        CREATE TABLE stories (
+            id integer NOT NULL DEFAULT nextval('stories_id_seq'),
+            queued_date timestamp without time zone NOT NULL,
+            {},
+            PRIMARY KEY (id, queued_date)
+        ) PARTITION BY RANGE (queued_date)
+    """.format(COLUMNS))
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY stories.id")
+    op.execute("CREATE TABLE stories_default PARTITION OF stories DEFAULT")
+    # one partition per week (starting on Mondays), from the oldest story we have until a few weeks from now
+    oldest = op.get_bind().execute(sa.text("SELECT MIN(queued_date) FROM stories_unpartitioned")).scalar()
+    today = dt.date.today()
+    week_start = (oldest.date() if oldest else today)
+    week_start -= dt.timedelta(days=week_start.weekday())
+    last_week_start = today - dt.timedelta(days=today.weekday()) + dt.timedelta(weeks=WEEKS_AHEAD)
+    while week_start <= last_week_start:
+        op.execute("CREATE TABLE stories_p{} PARTITION OF stories FOR VALUES FROM ('{}') TO ('{}')".format(
+            week_start.strftime("%Y%m%d"), week_start, week_start + dt.timedelta(weeks=1)))
+        week_start += dt.timedelta(weeks=1)
+    # stories without a queued_date (there shouldn't be any) get the best date we have for them
+    op.execute("""
+        INSERT INTO stories ({columns})
+        SELECT {select_columns} FROM stories_unpartitioned
+    """.format(
+        columns=COLUMN_NAMES,
+        select_columns=COLUMN_NAMES.replace(
+            "queued_date", "COALESCE(queued_date, processed_date, published_date, now()::timestamp)"),
+    ))
+    op.drop_table('stories_unpartitioned')
+    op.create_index('stories_project_id_url', 'stories', ['project_id', 'url'], unique=False)
+    op.create_index('stories_project_id_normalized_url', 'stories', ['project_id', 'normalized_url'], unique=False)
+    _create_indexes()
+
+
+def downgrade():
+    op.rename_table('stories', 'stories_partitioned')
+    for name, _, _ in INDEXES:
+        op.drop_index(name, table_name='stories_partitioned')
+    op.execute("ALTER TABLE stories_partitioned RENAME CONSTRAINT stories_pkey TO stories_partitioned_pkey")
+    op.execute("""
+        CREATE TABLE stories (
+            id integer NOT NULL DEFAULT nextval('stories_id_seq') PRIMARY KEY,
+            queued_date timestamp without time zone,
+            {}
+        )
+    """.format(COLUMNS))
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY stories.id")
+    # keep the first copy of any URL that was duplicated across partitions
+    op.execute("""
+        INSERT INTO stories ({columns})
+        SELECT DISTINCT ON (project_id, normalized_url) {columns} FROM stories_partitioned
+        ORDER BY project_id, normalized_url, id
+    """.format(columns=COLUMN_NAMES))
+    op.execute("DROP TABLE stories_partitioned CASCADE")
+    op.create_unique_constraint('uq_stories_project_id_url', 'stories', ['project_id', 'url'])
+    op.create_unique_constraint('uq_stories_project_id_normalized_url', 'stories', ['project_id', 'normalized_url'])
+    _create_indexes()
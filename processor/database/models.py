@@ -4,7 +4,7 @@ from typing import Dict
 
 import mcmetadata.urls as urls
 from dateutil.parser import parse
-from sqlalchemy import Boolean, DateTime, Float, Integer, String
+from sqlalchemy import Boolean, Date, DateTime, Float, Index, Integer, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 logger = logging.getLogger(__name__)
@@ -16,6 +16,13 @@ class Base(DeclarativeBase):
 
 class Story(Base):
     __tablename__ = "stories"
+    # On Postgres the table is partitioned by week on queued_date (so the primary key there is really (id,
+    # queued_date)), which means URLs can't be unique across the whole table. These indexes make checking for stories
+    # we've already seen for a project fast instead.
+    __table_args__ = (
+        Index("stories_project_id_url", "project_id", "url"),
+        Index("stories_project_id_normalized_url", "project_id", "normalized_url"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     project_id: Mapped[int] = mapped_column(Integer)
@@ -66,6 +73,34 @@ class Story(Base):
         return db_story
 
 
+class StoryCount(Base):
+    """
+    A rollup of how many stories we have by project, source, day and status. This is kept up to date as stories are
+    added, classified and posted (see stories_db), so the dashboard queries don't have to count up the stories table.
+    There can be more than one row for the same key (each change adds +/- rows), so always sum up `stories`.
+    """
+
+    __tablename__ = "story_counts"
+    __table_args__ = (
+        Index("story_counts_project_published_day", "project_id", "published_day"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    project_id: Mapped[int] = mapped_column(Integer)
+    source: Mapped[str] = mapped_column(String)
+    published_day: Mapped[dt.date] = mapped_column(Date)
+    processed_day: Mapped[dt.date] = mapped_column(Date, nullable=True)
+    above_threshold: Mapped[bool] = mapped_column(Boolean)
+    posted: Mapped[bool] = mapped_column(Boolean)
+    score_bucket: Mapped[float] = mapped_column(Float, nullable=True)
+    stories: Mapped[int] = mapped_column(Integer)
+
+    def __repr__(self):
+        return "<StoryCount project_id={} published_day={}>".format(
+            self.project_id, self.published_day
+        )
+
+
 class ProjectHistory(Base):
     __tablename__ = "projects"
 
@@ -1,28 +1,77 @@
-import copy
+import collections
 import datetime as dt
 import logging
-from typing import Dict, List
-
-from sqlalchemy import delete, select, text, update
-from sqlalchemy.exc import IntegrityError
+import os
+import time
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import (
+    ColumnElement,
+    Date,
+    Numeric,
+    Select,
+    cast,
+    delete,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import func
 
-from processor.database.models import Story
+from processor.database.models import Story, StoryCount
 
 logger = logging.getLogger(__name__)
 
+# how many stories to send to the database in each INSERT statement
+INSERT_BATCH_SIZE = 500
+# how many story ids to put in each UPDATE ... WHERE id IN (...) statement
+UPDATE_BATCH_SIZE = 1000
+# how many rows to stream from the database at a time when listing story URLs
+URL_QUERY_BATCH_SIZE = 5000
+
+# the stories table can be partitioned into weeks by queued_date (see the 79a4a6f3ae5e migration)
+PARTITION_PREFIX = "stories_p"
+DEFAULT_PARTITION = "stories_default"
+PARTITION_WEEKS_AHEAD = 4
+
+# deleting old stories from an unpartitioned table happens in small batches so it doesn't lock everyone else out
+DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", 5000))
+DELETE_BATCH_DELAY_SECS = float(os.environ.get("DELETE_BATCH_DELAY_SECS", 0.5))
+DELETE_MAX_RUNTIME_SECS = float(os.environ.get("DELETE_MAX_RUNTIME_SECS", 60 * 60))
+
+# the story_counts table rolls stories up by these (in this order), see `_story_counts_query`
+STORY_COUNT_COLUMNS = [
+    "project_id",
+    "source",
+    "published_day",
+    "processed_day",
+    "above_threshold",
+    "posted",
+    "score_bucket",
+    "stories",
+]
+# arbitrary first key for the Postgres advisory locks around checking for existing stories then inserting new ones
+STORY_INSERT_LOCK_ID = 1702
+
 
 def project_story_normalized_urls(
-    session: Session, project: Dict, last_n_days: int
-) -> List[str]:
+    session: Session,
+    project: Dict,
+    last_n_days: int,
+    only_urls: Optional[Iterable[str]] = None,
+) -> FrozenSet[str]:
     """
     This is helpful for de-duplication. We want to find out which stories were fetched and processed for this
     project in the last N days so that we can ignore them if we fetch those URLs again.
     :param session:
     :param project:
     :param last_n_days:
-    :return: a list of normalized URLs, ready to be compared against other URLs
+    :param only_urls: optionally only check these normalized URLs (instead of listing all of them)
+    :return: a set of normalized URLs, ready to be checked against other URLs
     """
     # use a time window to look for recent stories
     last_n_days_filter = Story.queued_date > (
@@ -32,14 +81,46 @@ def project_story_normalized_urls(
     project_id_filter = Story.project_id == project["id"]
     # make sure they weren't processed already
     not_processed_filter = Story.processed_date.is_not(None)
-    matching = (
-        session.query(Story)
-        .filter(project_id_filter)
-        .filter(last_n_days_filter)
-        .filter(not_processed_filter)
-        .all()
+    # only fetch the one column we need, and stream it because there can be lots for broad projects
+    query = (
+        select(Story.normalized_url)
+        .where(project_id_filter)
+        .where(last_n_days_filter)
+        .where(not_processed_filter)
+        .execution_options(yield_per=URL_QUERY_BATCH_SIZE)
+    )
+    if only_urls is not None:
+        query = query.where(Story.normalized_url.in_(list(only_urls)))
+    return frozenset(session.scalars(query))
+
+
+def project_story_ids_and_normalized_urls(
+    session: Session,
+    project: Dict,
+    since_id: Optional[int] = None,
+    last_n_days: Optional[int] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Stream the id and normalized URL of the stories we've queued for a project (processed or not), oldest first.
+    Useful for building up other indexes of which stories we already have.
+    :param session:
+    :param project:
+    :param since_id: only stories added after the one with this id
+    :param last_n_days: only stories queued in the last N days
+    :return:
+    """
+    query = select(Story.id, Story.normalized_url).where(
+        Story.project_id == project["id"]
     )
-    return [s.normalized_url for s in matching]
+    if since_id is not None:
+        query = query.where(Story.id > since_id)
+    if last_n_days is not None:
+        query = query.where(
+            Story.queued_date > (dt.datetime.now() - dt.timedelta(days=last_n_days))
+        )
+    query = query.order_by(Story.id).execution_options(yield_per=URL_QUERY_BATCH_SIZE)
+    for row in session.execute(query):
+        yield row.id, row.normalized_url
 
 
 def add_stories(
@@ -47,50 +128,114 @@ def add_stories(
 ) -> List[Dict]:
     """
     Logging: Track metadata about all the stories we process we, so we can audit it later (like a log file).
+    Stories are inserted in bulk, skipping any that are already there for this project, rather than inserting and
+    committing them one at a time.
     :param session:
     :param source_story_list:
     :param project:
     :param source:
-    :return: list of ids of objects inserted
+    :return: list of the stories that were inserted, each with a `log_db_id`
     """
-    ignored_count = 0
-    new_source_story_list = copy.copy(source_story_list)
     now = dt.datetime.now()
-    for discovered_story in new_source_story_list:
+    rows_by_normalized_url = {}
+    normalized_urls = []
+    for discovered_story in source_story_list:
         db_story = Story.from_source(discovered_story, source)
-        db_story.project_id = project["id"]
-        db_story.model_id = project["language_model_id"]
-        db_story.queued_date = now
-        db_story.above_threshold = False
-        discovered_story["db_story"] = db_story
+        normalized_urls.append(db_story.normalized_url)
+        # the first of any duplicates in the list wins
+        if db_story.normalized_url in rows_by_normalized_url:
+            continue
+        rows_by_normalized_url[db_story.normalized_url] = dict(
+            project_id=project["id"],
+            model_id=project["language_model_id"],
+            queued_date=now,
+            above_threshold=False,
+            source=db_story.source,
+            url=db_story.url,
+            normalized_url=db_story.normalized_url,
+            published_date=db_story.published_date,
+        )
     # now insert in batch to the database
-    for s in new_source_story_list:
-        try:
-            session.add(s["db_story"])
-            session.commit()
-        except IntegrityError:
-            # duplicate story, so just ignore it
-            session.rollback()
-            logger.debug(
-                f"Duplicate story found for project {project['id']}: {s['url']}"
-            )
-            del s["db_story"]
-            ignored_count += 1
+    ids_by_normalized_url = {}
+    rows = list(rows_by_normalized_url.values())
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        ids_by_normalized_url.update(
+            _insert_new_stories(session, rows[i : i + INSERT_BATCH_SIZE])
+        )
+    _add_story_count_deltas(
+        session,
+        collections.Counter(),
+        _story_count_keys(session, list(ids_by_normalized_url.values())),
+    )
+    session.commit()
     # only keep ones that inserted correctly
-    new_source_story_list = [
-        s for s in new_source_story_list if ("db_story" in s) and s["db_story"].id
-    ]
-    for s in new_source_story_list:
-        s["log_db_id"] = s[
-            "db_story"
-        ].id  # keep track of the db id, so we can use it later to update this story
-    for s in new_source_story_list:  # free the DB objects back for GC
-        if "db_story" in s:  # a little extra safety
-            del s["db_story"]
+    new_source_story_list = []
+    for s, normalized_url in zip(source_story_list, normalized_urls):
+        if normalized_url in ids_by_normalized_url:
+            # keep track of the db id, so we can use it later to update this story
+            s["log_db_id"] = ids_by_normalized_url.pop(normalized_url)
+            new_source_story_list.append(s)
+    ignored_count = len(source_story_list) - len(new_source_story_list)
     logger.info(f"  ignored {ignored_count} stories as duplicates")
     return new_source_story_list
 
 
+def _insert_new_stories(session: Session, rows: List[Dict]) -> Dict[str, int]:
+    """
+    Insert stories, skipping any that are already in the database for the same project.
+    :return: the new story ids, by normalized URL
+    """
+    # The stories table is partitioned by queued_date, and Postgres can't enforce uniqueness across partitions, so
+    # we have to look for existing copies ourselves. The ON CONFLICT still covers tables that have the old unique
+    # constraints.
+    if session.get_bind().dialect.name == "postgresql":
+        # stop two workers adding the same project's stories at the same time, so neither misses the other's copies
+        # (held until the transaction commits)
+        session.execute(
+            select(
+                func.pg_advisory_xact_lock(STORY_INSERT_LOCK_ID, rows[0]["project_id"])
+            )
+        )
+    existing = session.execute(
+        select(Story.url, Story.normalized_url)
+        .where(Story.project_id == rows[0]["project_id"])
+        .where(
+            or_(
+                Story.normalized_url.in_([r["normalized_url"] for r in rows]),
+                Story.url.in_([r["url"] for r in rows]),
+            )
+        )
+    ).all()
+    existing_urls = set([row.url for row in existing]) | set(
+        [row.normalized_url for row in existing]
+    )
+    rows = [
+        r
+        for r in rows
+        if (r["url"] not in existing_urls)
+        and (r["normalized_url"] not in existing_urls)
+    ]
+    if len(rows) == 0:
+        return {}
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(Story)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(Story)
+    else:
+        raise RuntimeError("Can't bulk insert stories into {}".format(dialect))
+    # no conflict target, so we skip stories that match on either url or normalized_url
+    statement = (
+        statement.values(rows)
+        .on_conflict_do_nothing()
+        .returning(Story.id, Story.normalized_url)
+    )
+    return {
+        normalized_url: story_id
+        for story_id, normalized_url in session.execute(statement)
+    }
+
+
 def update_stories_processed_date_score(session: Session, stories: List) -> None:
     """
     Logging: Once we have run the stories through the classifier models we want to save the scores.
@@ -99,18 +244,25 @@ def update_stories_processed_date_score(session: Session, stories: List) -> None
     :return:
     """
     now = dt.datetime.now()
-    for s in stories:
-        if "log_db_id" in s:  # more gracefully fail in test scenarios
-            session.execute(
-                update(Story)
-                .where(Story.id == s["log_db_id"])
-                .values(
-                    model_score=s["model_score"],
-                    model_1_score=s["model_1_score"],
-                    model_2_score=s["model_2_score"],
-                    processed_date=now,
-                )
-            )  # [updated]
+    story_scores = [
+        dict(
+            id=s["log_db_id"],
+            model_score=s["model_score"],
+            model_1_score=s["model_1_score"],
+            model_2_score=s["model_2_score"],
+            processed_date=now,
+        )
+        for s in stories
+        if "log_db_id" in s  # more gracefully fail in test scenarios
+    ]
+    if len(story_scores) > 0:
+        story_ids = [s["id"] for s in story_scores]
+        counts_before = _story_count_keys(session, story_ids)
+        # a bulk update by primary key, so this is sent as one executemany statement
+        session.execute(update(Story), story_scores)
+        _add_story_count_deltas(
+            session, counts_before, _story_count_keys(session, story_ids)
+        )
     session.commit()
 
 
@@ -122,10 +274,12 @@ def update_stories_above_threshold(session: Session, stories: List) -> None:
     :param stories:
     :return:
     """
-    for s in stories:
-        session.execute(
-            update(Story).where(Story.id == s["log_db_id"]).values(above_threshold=True)
-        )  # [updated]
+    story_ids = [s["log_db_id"] for s in stories]
+    counts_before = _story_count_keys(session, story_ids)
+    _update_stories_by_id(session, story_ids, above_threshold=True)
+    _add_story_count_deltas(
+        session, counts_before, _story_count_keys(session, story_ids)
+    )
     session.commit()
 
 
@@ -137,10 +291,154 @@ def update_stories_posted_date(session: Session, stories: List) -> None:
     :return:
     """
     now = dt.datetime.now()
-    for s in stories:
+    story_ids = [s["log_db_id"] for s in stories]
+    counts_before = _story_count_keys(session, story_ids)
+    _update_stories_by_id(session, story_ids, posted_date=now)
+    _add_story_count_deltas(
+        session, counts_before, _story_count_keys(session, story_ids)
+    )
+    session.commit()
+
+
+def _update_stories_by_id(session: Session, story_ids: List[int], **values) -> None:
+    """
+    Set the same values on a bunch of stories with one UPDATE statement (per batch of ids).
+    """
+    for i in range(0, len(story_ids), UPDATE_BATCH_SIZE):
         session.execute(
-            update(Story).where(Story.id == s["log_db_id"]).values(posted_date=now)
-        )  # [updated]
+            update(Story)
+            .where(Story.id.in_(story_ids[i : i + UPDATE_BATCH_SIZE]))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _day(session: Session, column) -> ColumnElement:
+    """
+    The date part of a timestamp column (SQLite doesn't understand casting to a date).
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        return func.date(column, type_=Date)
+    return cast(column, Date)
+
+
+def _story_counts_query(session: Session, negate: bool = False) -> Select:
+    """
+    Roll up the stories table into the columns of story_counts (filter this to pick which stories to count).
+    :param negate: count the stories as negative, to take them back out of the counts
+    """
+    published_day = _day(session, Story.published_date)
+    processed_day = _day(session, Story.processed_date)
+    posted = Story.posted_date.is_not(None)
+    score_bucket = func.round(cast(Story.model_score, Numeric), 1)
+    return select(
+        Story.project_id,
+        Story.source,
+        published_day,
+        processed_day,
+        Story.above_threshold,
+        posted,
+        score_bucket,
+        -func.count() if negate else func.count(),
+    ).group_by(
+        Story.project_id,
+        Story.source,
+        published_day,
+        processed_day,
+        Story.above_threshold,
+        posted,
+        score_bucket,
+    )
+
+
+def _insert_story_counts(session: Session, query: Select) -> None:
+    session.execute(
+        insert(StoryCount).from_select(STORY_COUNT_COLUMNS, query),
+        execution_options=dict(synchronize_session=False),
+    )
+
+
+def _story_count_keys(session: Session, story_ids: List[int]) -> collections.Counter:
+    """
+    Which story_counts rows (ie. all the columns but `stories`) these stories are counted in right now, and how many
+    of them are in each one.
+    """
+    counts = collections.Counter()
+    for i in range(0, len(story_ids), UPDATE_BATCH_SIZE):
+        for row in session.execute(
+            _story_counts_query(session).where(
+                Story.id.in_(story_ids[i : i + UPDATE_BATCH_SIZE])
+            )
+        ):
+            counts[tuple(row[:-1])] += row[-1]
+    return counts
+
+
+def _add_story_count_deltas(
+    session: Session, before: collections.Counter, after: collections.Counter
+) -> None:
+    """
+    Move stories from the story_counts rows they used to be counted in to the ones they are counted in now. Rather than
+    updating rows in place (which would need a lock so concurrent workers don't overwrite each other), this appends
+    +/- rows - the dashboard queries all sum them up, and `compact_story_counts` squashes them back down each night.
+    """
+    deltas = collections.Counter(after)
+    deltas.subtract(before)
+    rows = [
+        dict(zip(STORY_COUNT_COLUMNS, key + (stories,)))
+        for key, stories in deltas.items()
+        if stories != 0
+    ]
+    if len(rows) > 0:
+        session.execute(insert(StoryCount), rows)
+
+
+def _lock_story_counts(session: Session) -> None:
+    """
+    Stop anyone else adding to story_counts until this transaction ends (they can still read it). Workers add their
+    story and its +/- rows in the same transaction, so while we hold this none of their changes can be half-counted.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("LOCK TABLE story_counts IN EXCLUSIVE MODE"))
+
+
+def compact_story_counts(session: Session) -> None:
+    """
+    Squash the +/- rows that build up in story_counts into one row per key (dropping the ones that add up to zero).
+    This runs nightly, and only reads story_counts (not the much bigger stories table).
+    """
+    _lock_story_counts(session)
+    max_id = session.execute(select(func.max(StoryCount.id))).scalar()
+    if max_id is None:
+        session.commit()
+        return
+    keys = [getattr(StoryCount, c) for c in STORY_COUNT_COLUMNS[:-1]]
+    total = func.sum(StoryCount.stories)
+    # the new rows all get ids after max_id (nobody else can add any while we hold the lock), so then the old ones
+    # can be deleted by id
+    session.execute(
+        insert(StoryCount).from_select(
+            STORY_COUNT_COLUMNS,
+            select(*keys, total).group_by(*keys).having(total != 0),
+        ),
+        execution_options=dict(synchronize_session=False),
+    )
+    session.execute(
+        delete(StoryCount)
+        .where(StoryCount.id <= max_id)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+
+def rebuild_story_counts(session: Session) -> None:
+    """
+    Recompute the whole story_counts table from scratch, for fixing them by hand (ie. if they have drifted, or after
+    changing how they are computed). This scans the whole stories table, so the nightly job compacts them instead.
+    """
+    _lock_story_counts(session)
+    session.execute(delete(StoryCount).execution_options(synchronize_session=False))
+    _insert_story_counts(session, _story_counts_query(session))
     session.commit()
 
 
@@ -179,27 +477,26 @@ def _stories_by_date_col(
     limit: int = 30,
 ) -> List:
     earliest_date = dt.date.today() - dt.timedelta(days=limit)
-    clauses = []
+    # read from the rollup table, rather than counting up the stories every time
+    day_column = dict(
+        processed_date=StoryCount.processed_day,
+        published_date=StoryCount.published_day,
+    )[column_name]
+    query = (
+        select(day_column.label("day"), func.sum(StoryCount.stories).label("stories"))
+        .where(day_column.is_not(None))
+        .where(day_column >= earliest_date)
+    )
     if project_id is not None:
-        clauses.append("(project_id={})".format(project_id))
+        query = query.where(StoryCount.project_id == project_id)
     if platform is not None:
-        clauses.append("(source='{}')".format(platform))
+        query = query.where(StoryCount.source == platform)
     if above_threshold is not None:
-        clauses.append(
-            "(above_threshold is {})".format("True" if above_threshold else "False")
-        )
+        query = query.where(StoryCount.above_threshold == above_threshold)
     if is_posted is not None:
-        clauses.append("(posted_date {} Null)".format("is not" if is_posted else "is"))
-    query = (
-        "select " + column_name + "::date as day, count(1) as stories from stories "
-        "where ("
-        + column_name
-        + " is not Null) and ("
-        + column_name
-        + " >= '{}'::DATE) AND {} "
-        "group by 1 order by 1 DESC".format(earliest_date, " AND ".join(clauses))
-    )
-    return _run_query(session, query)
+        query = query.where(StoryCount.posted == is_posted)
+    query = query.group_by(day_column).order_by(day_column.desc())
+    return [row._mapping for row in session.execute(query)]
 
 
 def stories_by_posted_day(
@@ -259,33 +556,25 @@ def stories_by_published_day(
     )
 
 
-def _run_query(session: Session, query: str) -> List:
-    results = session.execute(text(query))
-    data = []
-    for row in results:
-        data.append(row._mapping)
-    return data
-
-
-def _run_count_query(session: Session, query: str) -> int:
-    data = _run_query(session, query)
-    return data[0]["count"]
-
-
 def unposted_above_story_count(
     session: Session, project_id: int, limit: int = None
 ) -> int:
     """
     UI: How many stories about threshold have *not* been sent to main server (should be zero!).
     """
-    date_clause = "(posted_date is not Null)"
+    query = (
+        select(func.count())
+        .select_from(Story)
+        .where(Story.project_id == project_id)
+        .where(Story.above_threshold.is_(True))
+        .where(Story.posted_date.is_(None))
+    )
     if limit:
+        # unposted stories have no posted_date to limit by, so go by when they were processed (a range on the column
+        # itself, rather than casting it to a date, can use the partial processed_date/above_threshold index)
         earliest_date = dt.date.today() - dt.timedelta(days=limit)
-        date_clause += " AND (posted_date >= '{}'::DATE)".format(earliest_date)
-    query = "select count(1) from stories where project_id={} and above_threshold is True and {}".format(
-        project_id, date_clause
-    )
-    return _run_count_query(session, query)
+        query = query.where(Story.processed_date >= earliest_date)
+    return session.execute(query).scalar()
 
 
 def posted_above_story_count(session: Session, project_id: int) -> int:
@@ -294,13 +583,12 @@ def posted_above_story_count(session: Session, project_id: int) -> int:
     :param project_id:
     :return:
     """
-    query = (
-        "select count(1) from stories "
-        "where project_id={} and posted_date is not Null and above_threshold is True".format(
-            project_id
-        )
+    return _story_count(
+        session,
+        (StoryCount.project_id == project_id)
+        & (StoryCount.posted.is_(True))
+        & (StoryCount.above_threshold.is_(True)),
     )
-    return _run_count_query(session, query)
 
 
 def below_story_count(session: Session, project_id: int) -> int:
@@ -309,10 +597,16 @@ def below_story_count(session: Session, project_id: int) -> int:
     :param project_id:
     :return:
     """
-    query = "select count(1) from stories where project_id={} and above_threshold is False".format(
-        project_id
+    return _story_count(
+        session,
+        (StoryCount.project_id == project_id) & (StoryCount.above_threshold.is_(False)),
     )
-    return _run_count_query(session, query)
+
+
+def _story_count(session: Session, clause: ColumnElement) -> int:
+    return session.execute(
+        select(func.coalesce(func.sum(StoryCount.stories), 0)).where(clause)
+    ).scalar()
 
 
 def unposted_stories(session: Session, project_id: int, limit: int):
@@ -321,41 +615,268 @@ def unposted_stories(session: Session, project_id: int, limit: int):
     :return:
     """
     earliest_date = dt.date.today() - dt.timedelta(days=limit)
+    # the plain table rather than ORM objects, so callers get rows (mappings) like before
     query = (
-        "select * from stories "
-        "where project_id={} and posted_date is Null and (posted_date >= '{}'::DATE) and above_threshold is True".format(
-            project_id, earliest_date
-        )
+        select(Story.__table__)
+        .where(Story.project_id == project_id)
+        .where(Story.posted_date.is_(None))
+        .where(Story.processed_date >= earliest_date)
+        .where(Story.above_threshold.is_(True))
     )
-    """
-    session = Session()
-    q = session.query(Story). \
-        filter(Story.project_id == project_id). \
-        filter(Story.above_threshold is True). \
-        filter(Story.posted_date is None)
-    return q.all()
-    """
-    return _run_query(session, query)
+    return [row._mapping for row in session.execute(query)]
 
 
 def project_binned_model_scores(session: Session, project_id: int) -> List:
-    query = """
-        select ROUND(CAST(model_score as numeric), 1) as value, count(1) as frequency
-        from stories
-        where project_id={} and model_score is not NULL
-        group by 1
-        order by 1
-    """.format(
-        project_id
+    query = (
+        select(
+            StoryCount.score_bucket.label("value"),
+            func.sum(StoryCount.stories).label("frequency"),
+        )
+        .where(StoryCount.project_id == project_id)
+        .where(StoryCount.score_bucket.is_not(None))
+        .group_by(StoryCount.score_bucket)
+        .order_by(StoryCount.score_bucket)
     )
-    return _run_query(session, query)
+    return [row._mapping for row in session.execute(query)]
 
 
-def delete_old_stories(session: Session, age: int = 62) -> None:
+def delete_old_stories(
+    session: Session,
+    age: int = 62,
+    batch_size: int = DELETE_BATCH_SIZE,
+    batch_delay_secs: float = DELETE_BATCH_DELAY_SECS,
+    max_runtime_secs: Optional[float] = DELETE_MAX_RUNTIME_SECS,
+) -> None:
     """
-    Delete stories that have been posted more than 62 days ago.
+    Delete stories that have been posted more than 62 days ago. If the stories table is partitioned we just drop the
+    weekly partitions that are entirely older than that, which is much cheaper than deleting rows. Otherwise they are
+    deleted in batches so we don't hold locks on the table for ages (see `_delete_stories_in_batches`). Either way
+    they are taken back out of story_counts too.
     """
     today = dt.datetime.now()
     date_cutoff = today - dt.timedelta(days=age)
-    session.execute(delete(Story).where(Story.queued_date < date_cutoff))
+    if stories_partitioned(session):
+        partitions = story_partitions(session)
+        for name in old_story_partitions(session, date_cutoff):
+            logger.info("Dropping stories partition {}".format(name))
+            # take them out of the counts first (the date range means only this partition gets scanned), making sure
+            # nobody changes them in the meantime
+            session.execute(text("LOCK TABLE {} IN EXCLUSIVE MODE".format(name)))
+            week_start = partitions[name]
+            _insert_story_counts(
+                session,
+                _story_counts_query(session, negate=True)
+                .where(Story.queued_date >= week_start)
+                .where(Story.queued_date < week_start + dt.timedelta(weeks=1)),
+            )
+            session.execute(
+                text("ALTER TABLE stories DETACH PARTITION {}".format(name))
+            )
+            session.execute(text("DROP TABLE {}".format(name)))
+        # anything that ended up outside the weekly partitions has to be deleted the slow way
+        session.execute(
+            text("LOCK TABLE {} IN EXCLUSIVE MODE".format(DEFAULT_PARTITION))
+        )
+        _insert_story_counts(
+            session,
+            _story_counts_query(session, negate=True)
+            .where(Story.queued_date < date_cutoff)
+            .where(text("stories.tableoid = '{}'::regclass".format(DEFAULT_PARTITION))),
+        )
+        session.execute(
+            text(
+                "DELETE FROM {} WHERE queued_date < :date_cutoff".format(
+                    DEFAULT_PARTITION
+                )
+            ),
+            dict(date_cutoff=date_cutoff),
+        )
+    else:
+        _delete_stories_in_batches(
+            session, date_cutoff, batch_size, batch_delay_secs, max_runtime_secs
+        )
     session.commit()
+
+
+def _delete_stories_in_batches(
+    session: Session,
+    date_cutoff: dt.datetime,
+    batch_size: int,
+    batch_delay_secs: float,
+    max_runtime_secs: Optional[float],
+) -> int:
+    """
+    Delete stories queued before the cutoff, oldest ids first, committing after each batch so other connections can
+    get at the table in between. Stops early if it runs longer than `max_runtime_secs` (the rest will get deleted the
+    next time this runs).
+    :return: how many stories were deleted
+    """
+    start_time = time.monotonic()
+    deleted_count = 0
+    while True:
+        story_ids = session.scalars(
+            select(Story.id)
+            .where(Story.queued_date < date_cutoff)
+            .order_by(Story.id)
+            .limit(batch_size)
+        ).all()
+        if len(story_ids) == 0:
+            break
+        counts_before = _story_count_keys(session, story_ids)
+        session.execute(
+            delete(Story)
+            .where(Story.id.in_(story_ids))
+            .execution_options(synchronize_session=False)
+        )
+        _add_story_count_deltas(session, counts_before, collections.Counter())
+        session.commit()
+        deleted_count += len(story_ids)
+        logger.info(
+            "Deleted {} old stories so far (up to id {})".format(
+                deleted_count, story_ids[-1]
+            )
+        )
+        if len(story_ids) < batch_size:
+            break
+        if (max_runtime_secs is not None) and (
+            time.monotonic() - start_time > max_runtime_secs
+        ):
+            logger.warning(
+                "Stopped deleting old stories after {} secs; will finish next time".format(
+                    max_runtime_secs
+                )
+            )
+            break
+        if batch_delay_secs:
+            time.sleep(batch_delay_secs)
+    return deleted_count
+
+
+def stories_partitioned(session: Session) -> bool:
+    """
+    Has the stories table been partitioned by queued_date (see the 79a4a6f3ae5e migration)? Only possible on Postgres.
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return False
+    return session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'stories'::regclass)"
+        )
+    ).scalar()
+
+
+def _partition_week_start(day: dt.date) -> dt.date:
+    return day - dt.timedelta(days=day.weekday())
+
+
+def story_partitions(session: Session) -> Dict[str, dt.date]:
+    """
+    :return: the weekly partitions of the stories table, by name, with the date each one starts on
+    """
+    names = session.scalars(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'stories'::regclass"
+        )
+    ).all()
+    partitions = {}
+    for name in names:
+        if name.startswith(PARTITION_PREFIX):
+            partitions[name] = dt.datetime.strptime(
+                name[len(PARTITION_PREFIX) :], "%Y%m%d"
+            ).date()
+    return partitions
+
+
+def old_story_partitions(session: Session, date_cutoff: dt.datetime) -> List[str]:
+    """
+    :return: names of the weekly partitions that only hold stories queued before the cutoff
+    """
+    return sorted(
+        [
+            name
+            for name, week_start in story_partitions(session).items()
+            if dt.datetime.combine(week_start + dt.timedelta(weeks=1), dt.time())
+            <= date_cutoff
+        ]
+    )
+
+
+def create_story_partitions(
+    session: Session, weeks_ahead: int = PARTITION_WEEKS_AHEAD
+) -> None:
+    """
+    Make sure there are weekly partitions for stories we'll queue over the next few weeks, so they don't end up in
+    the default partition. Does nothing if the table isn't partitioned.
+    """
+    if not stories_partitioned(session):
+        return
+    existing = story_partitions(session)
+    week_start = _partition_week_start(dt.date.today())
+    for _ in range(weeks_ahead + 1):
+        name = "{}{}".format(PARTITION_PREFIX, week_start.strftime("%Y%m%d"))
+        if name not in existing:
+            _create_story_partition(
+                session, name, week_start, week_start + dt.timedelta(weeks=1)
+            )
+        week_start += dt.timedelta(weeks=1)
+    session.commit()
+
+
+def _create_story_partition(
+    session: Session, name: str, start: dt.date, end: dt.date
+) -> None:
+    """
+    Postgres won't create a partition for a range that the default partition already has rows in (ie. stories queued
+    when there wasn't a partition for them yet). In that case the default partition is detached while the new one is
+    made, and those rows are moved across. This all happens in the caller's transaction, so nobody else can insert
+    stories in the meantime.
+    """
+    values = dict(start=start, end=end)
+    in_default = session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM {} WHERE queued_date >= :start AND queued_date < :end)".format(
+                DEFAULT_PARTITION
+            )
+        ),
+        values,
+    ).scalar()
+    create_statement = text(
+        "CREATE TABLE {} PARTITION OF stories FOR VALUES FROM ('{}') TO ('{}')".format(
+            name, start, end
+        )
+    )
+    if not in_default:
+        logger.info("Creating stories partition {}".format(name))
+        session.execute(create_statement)
+        return
+    logger.info(
+        "Creating stories partition {} (moving its stories out of {})".format(
+            name, DEFAULT_PARTITION
+        )
+    )
+    session.execute(
+        text("ALTER TABLE stories DETACH PARTITION {}".format(DEFAULT_PARTITION))
+    )
+    session.execute(create_statement)
+    session.execute(
+        text(
+            "INSERT INTO {} SELECT * FROM {} WHERE queued_date >= :start AND queued_date < :end".format(
+                name, DEFAULT_PARTITION
+            )
+        ),
+        values,
+    )
+    session.execute(
+        text(
+            "DELETE FROM {} WHERE queued_date >= :start AND queued_date < :end".format(
+                DEFAULT_PARTITION
+            )
+        ),
+        values,
+    )
+    session.execute(
+        text(
+            "ALTER TABLE stories ATTACH PARTITION {} DEFAULT".format(DEFAULT_PARTITION)
+        )
+    )
@@ -0,0 +1,39 @@
+import multiprocessing
+import unittest
+
+from sqlalchemy import text
+
+import processor.database as database
+
+
+def _engine_in_child(results):
+    inherited_engine = database._engine
+    engine = database._get_engine()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    results.put(engine is not inherited_engine)
+
+
+class TestEngine(unittest.TestCase):
+    def test_same_engine_in_process(self):
+        assert database._get_engine() is database._get_engine()
+        assert database.get_session_maker() is database.get_session_maker()
+
+    def test_new_engine_after_fork(self):
+        engine = database._get_engine()
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        child = context.Process(target=_engine_in_child, args=(results,))
+        child.start()
+        child.join()
+        assert results.get(timeout=10) is True
+        # the parent's engine is untouched
+        assert database._get_engine() is engine
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
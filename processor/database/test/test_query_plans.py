@@ -0,0 +1,93 @@
+import unittest
+
+from sqlalchemy import event, text
+
+import processor.database as database
+import processor.database.stories_db as stories_db
+
+TEST_PROJECT_ID = 0
+
+
+class TestQueryPlans(unittest.TestCase):
+    """
+    Make sure the dashboard queries are written so they can use our indexes. Query plans are only checked on Postgres
+    (which is what we run in production and CI).
+    """
+
+    def setUp(self):
+        Session = database.get_session_maker()
+        self.session = Session()
+        if self.session.get_bind().dialect.name != "postgresql":
+            self.session.close()
+            self.skipTest("Query plans are only checked on Postgres")
+        # the test tables are tiny, so tell the planner to use an index if it possibly can
+        self.session.execute(text("SET enable_seqscan = off"))
+        self._statements = []
+        event.listen(
+            self.session.connection(), "before_cursor_execute", self._save_statement
+        )
+
+    def tearDown(self):
+        self.session.rollback()
+        self.session.close()
+
+    def _save_statement(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        self._statements.append((statement, parameters))
+
+    def _query_plan(self, run_query) -> str:
+        run_query()
+        statement, parameters = self._statements[-1]
+        rows = self.session.connection().exec_driver_sql(
+            "EXPLAIN " + statement, parameters
+        )
+        return "\n".join([row[0] for row in rows])
+
+    def _assert_uses_index(self, run_query):
+        plan = self._query_plan(run_query)
+        assert "Index" in plan, plan
+        assert "Seq Scan" not in plan, plan
+
+    def test_unposted_above_story_count(self):
+        self._assert_uses_index(
+            lambda: stories_db.unposted_above_story_count(
+                self.session, TEST_PROJECT_ID, 30
+            )
+        )
+
+    def test_unposted_stories(self):
+        self._assert_uses_index(
+            lambda: stories_db.unposted_stories(self.session, TEST_PROJECT_ID, 30)
+        )
+
+    def test_below_story_count(self):
+        self._assert_uses_index(
+            lambda: stories_db.below_story_count(self.session, TEST_PROJECT_ID)
+        )
+
+    def test_posted_above_story_count(self):
+        self._assert_uses_index(
+            lambda: stories_db.posted_above_story_count(self.session, TEST_PROJECT_ID)
+        )
+
+    def test_project_binned_model_scores(self):
+        self._assert_uses_index(
+            lambda: stories_db.project_binned_model_scores(
+                self.session, TEST_PROJECT_ID
+            )
+        )
+
+    def test_stories_by_day(self):
+        self._assert_uses_index(
+            lambda: stories_db.stories_by_processed_day(self.session, TEST_PROJECT_ID)
+        )
+        self._assert_uses_index(
+            lambda: stories_db.stories_by_published_day(
+                self.session, TEST_PROJECT_ID, above_threshold=True
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,9 @@
+import collections
+import datetime as dt
 import unittest
+from unittest.mock import MagicMock
+
+import mcmetadata.urls as urls
 
 import processor
 import processor.database as database
@@ -9,6 +14,59 @@ from processor.test import sample_stories
 TEST_EN_PROJECT = dict(id=0, language="en", language_model_id=1)
 
 
+class TestCreateStoryPartition(unittest.TestCase):
+    def _statements(self, in_default: bool):
+        session = MagicMock()
+        session.execute.return_value.scalar.return_value = in_default
+        stories_db._create_story_partition(
+            session, "stories_p20240101", dt.date(2024, 1, 1), dt.date(2024, 1, 8)
+        )
+        return [str(c[0][0]) for c in session.execute.call_args_list]
+
+    def test_empty_default(self):
+        statements = self._statements(False)
+        assert len(statements) == 2
+        assert statements[1].startswith("CREATE TABLE stories_p20240101 PARTITION OF")
+
+    def test_moves_rows_out_of_default(self):
+        statements = self._statements(True)
+        assert [s.split(" ")[0] for s in statements] == [
+            "SELECT",
+            "ALTER",
+            "CREATE",
+            "INSERT",
+            "DELETE",
+            "ALTER",
+        ]
+        assert "DETACH PARTITION stories_default" in statements[1]
+        assert statements[3].startswith(
+            "INSERT INTO stories_p20240101 SELECT * FROM stories_default"
+        )
+        assert statements[5].endswith("ATTACH PARTITION stories_default DEFAULT")
+
+
+class TestInsertNewStories(unittest.TestCase):
+    def test_locks_project_before_checking(self):
+        session = MagicMock()
+        session.get_bind.return_value.dialect.name = "postgresql"
+        session.execute.return_value.all.return_value = []
+        rows = [
+            dict(
+                project_id=7,
+                url="https://example.com/a",
+                normalized_url="example.com/a",
+            )
+        ]
+        stories_db._insert_new_stories(session, rows)
+        statements = [c[0][0] for c in session.execute.call_args_list]
+        assert "pg_advisory_xact_lock" in str(statements[0])
+        assert sorted(statements[0].compile().params.values()) == [
+            7,
+            stories_db.STORY_INSERT_LOCK_ID,
+        ]
+        assert "FROM stories" in str(statements[1])
+
+
 class TestStoriesDb(unittest.TestCase):
     def setUp(self):
         Session = database.get_session_maker()
@@ -21,6 +79,7 @@ class TestStoriesDb(unittest.TestCase):
         Session = database.get_session_maker()
         with Session() as session:
             session.query(models.Story).delete()
+            session.query(models.StoryCount).delete()
             session.query(models.ProjectHistory).delete()
 
     def _story_count(self):
@@ -34,6 +93,7 @@ class TestStoriesDb(unittest.TestCase):
         Session = database.get_session_maker()
         with Session() as session:
             session.query(models.Story).delete()
+            session.query(models.StoryCount).delete()
             session.commit()
         assert self._story_count() == 0
 
@@ -52,6 +112,158 @@ class TestStoriesDb(unittest.TestCase):
             )
             session.commit()
             assert len(stories_to_queue) == unique_urls
+            assert len(set([s["log_db_id"] for s in stories_to_queue])) == unique_urls
         # try to add them again
         assert self._story_count() == len(stories_to_queue)
+        with Session() as session:
+            stories_to_queue = stories_db.add_stories(
+                session, page_of_stories, TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            assert len(stories_to_queue) == 0
+        assert self._story_count() == unique_urls
+        self._remove_all_stories()
+
+    def test_update_stories(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            stories = stories_db.add_stories(
+                session, sample_stories(), TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            for s in stories:
+                s["model_score"] = s["model_1_score"] = 0.75
+                s["model_2_score"] = None
+            stories_db.update_stories_processed_date_score(session, stories)
+            stories_db.update_stories_above_threshold(session, stories[:2])
+            stories_db.update_stories_posted_date(session, stories[:1])
+        with Session() as session:
+            db_stories = session.query(models.Story).all()
+            assert len(db_stories) == len(stories)
+            for s in db_stories:
+                assert s.model_score == 0.75
+                assert s.processed_date is not None
+            assert len([s for s in db_stories if s.above_threshold]) == 2
+            assert len([s for s in db_stories if s.posted_date is not None]) == 1
+        self._remove_all_stories()
+
+    def test_project_story_normalized_urls(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            stories = stories_db.add_stories(
+                session, sample_stories(), TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            # only processed stories count
+            for s in stories:
+                s["model_score"] = s["model_1_score"] = s["model_2_score"] = 0.5
+            stories_db.update_stories_processed_date_score(session, stories[:3])
+            normalized_urls = stories_db.project_story_normalized_urls(
+                session, TEST_EN_PROJECT, 14
+            )
+        assert isinstance(normalized_urls, frozenset)
+        assert len(normalized_urls) == 3
+        assert urls.normalize_url(stories[0]["url"]) in normalized_urls
+        self._remove_all_stories()
+
+    def test_delete_old_stories(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            stories = stories_db.add_stories(
+                session, sample_stories(), TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            # make some of them old
+            old_ids = [s["log_db_id"] for s in stories[:7]]
+            session.query(models.Story).filter(models.Story.id.in_(old_ids)).update(
+                dict(queued_date=dt.datetime.now() - dt.timedelta(days=100))
+            )
+            session.commit()
+            stories_db.delete_old_stories(session, 62, batch_size=3, batch_delay_secs=0)
+            # and they come out of the counts too
+            assert sum(self._summed_story_counts(session).values()) == len(
+                stories
+            ) - len(old_ids)
+        assert self._story_count() == len(stories) - len(old_ids)
+        self._remove_all_stories()
+
+    def _summed_story_counts(self, session) -> collections.Counter:
+        counts = collections.Counter()
+        for row in session.query(models.StoryCount).all():
+            key = tuple(
+                getattr(row, c)
+                for c in stories_db.STORY_COUNT_COLUMNS
+                if c != "stories"
+            )
+            counts[key] += row.stories
+        return +counts  # drop the keys that net out to zero
+
+    def test_story_count_deltas(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            stories = stories_db.add_stories(
+                session, sample_stories(), TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            for s in stories:
+                s["model_score"] = s["model_1_score"] = 0.9
+                s["model_2_score"] = None
+            stories_db.update_stories_processed_date_score(session, stories)
+            stories_db.update_stories_above_threshold(session, stories[:4])
+            stories_db.update_stories_posted_date(session, stories[:3])
+            # changes add rows rather than updating them in place
+            row_count = session.query(models.StoryCount).count()
+            incremental = self._summed_story_counts(session)
+            assert sum(incremental.values()) == len(stories)
+            # squashed down to one row per key, with the same totals
+            stories_db.compact_story_counts(session)
+            assert session.query(models.StoryCount).count() == len(incremental)
+            assert session.query(models.StoryCount).count() < row_count
+            assert self._summed_story_counts(session) == incremental
+            # which is what counting them from scratch gives
+            stories_db.rebuild_story_counts(session)
+            assert self._summed_story_counts(session) == incremental
+        self._remove_all_stories()
+
+    def test_story_counts(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            stories = stories_db.add_stories(
+                session, sample_stories(), TEST_EN_PROJECT, processor.SOURCE_MEDIA_CLOUD
+            )
+            for idx, s in enumerate(stories):
+                s["model_score"] = s["model_1_score"] = 0.9 if idx < 4 else 0.12
+                s["model_2_score"] = None
+            stories_db.update_stories_processed_date_score(session, stories)
+            stories_db.update_stories_above_threshold(session, stories[:4])
+            stories_db.update_stories_posted_date(session, stories[:3])
+            # one above threshold but not posted (it used to count the posted ones, ie. the same as
+            # posted_above_story_count, which is why it never showed up as the non-zero it should be here)
+            assert (
+                stories_db.unposted_above_story_count(session, TEST_EN_PROJECT["id"])
+                == 1
+            )
+            assert (
+                stories_db.unposted_above_story_count(
+                    session, TEST_EN_PROJECT["id"], 30
+                )
+                == 1
+            )
+            for _ in range(2):
+                assert stories_db.below_story_count(session, TEST_EN_PROJECT["id"]) == (
+                    len(stories) - 4
+                )
+                assert (
+                    stories_db.posted_above_story_count(session, TEST_EN_PROJECT["id"])
+                    == 3
+                )
+                scores = stories_db.project_binned_model_scores(
+                    session, TEST_EN_PROJECT["id"]
+                )
+                assert [(s["value"], s["frequency"]) for s in scores] == [
+                    (0.1, len(stories) - 4),
+                    (0.9, 4),
+                ]
+                by_day = stories_db.stories_by_processed_day(
+                    session, TEST_EN_PROJECT["id"], processor.SOURCE_MEDIA_CLOUD
+                )
+                assert by_day[0]["day"] == dt.date.today()
+                assert by_day[0]["stories"] == len(stories)
+                # rebuilding from scratch should give the same answers
+                stories_db.rebuild_story_counts(session)
         self._remove_all_stories()
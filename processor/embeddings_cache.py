@@ -0,0 +1,119 @@
+import datetime as dt
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+from processor import base_dir
+
+logger = logging.getLogger(__name__)
+
+# the same story text often gets classified many times (multiple projects, multiple sources), so we save the
+# embeddings we compute to disk and look them up before running the (slow) embeddings model again
+EMBEDDINGS_CACHE_ENABLED = os.environ.get("EMBEDDINGS_CACHE_ENABLED", "1") == "1"
+EMBEDDINGS_CACHE_PATH = os.environ.get(
+    "EMBEDDINGS_CACHE_PATH", os.path.join(base_dir, "files", "embeddings-cache.db")
+)
+# vectors older than this get deleted (each host has its own cache file, so every worker prunes its own on startup)
+EMBEDDINGS_CACHE_MAX_AGE_DAYS = int(os.environ.get("EMBEDDINGS_CACHE_MAX_AGE_DAYS", 30))
+
+# one per process, because sqlite connections can't be shared across forks
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class EmbeddingsCache:
+    """
+    A little on-disk key-value store of embeddings vectors, keyed by the embeddings model version and a hash of the text.
+    Backed by sqlite so it can be shared safely by all the worker processes on one machine.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "  model TEXT NOT NULL,"
+            "  text_hash TEXT NOT NULL,"
+            "  vector BLOB NOT NULL,"
+            "  created_at TEXT NOT NULL,"
+            "  PRIMARY KEY (model, text_hash)"
+            ")"
+        )
+        self._connection.commit()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        :return: a vector for each text passed in, or None for the ones that aren't in the cache
+        """
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            # stay well under sqlite's limit on the number of query parameters
+            for i in range(0, len(hashes), 500):
+                chunk = list(set(hashes[i : i + 500]))
+                rows = self._connection.execute(
+                    "SELECT text_hash, vector FROM embeddings WHERE model=? AND text_hash IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    [model] + chunk,
+                ).fetchall()
+                for h, vector in rows:
+                    found[h] = np.frombuffer(vector, dtype=np.float32)
+        return [found.get(h) for h in hashes]
+
+    def put_many(self, model: str, texts: List[str], vectors: np.ndarray) -> None:
+        now = dt.datetime.now().isoformat()
+        rows = [
+            (model, text_hash(t), np.asarray(v, dtype=np.float32).tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._connection.commit()
+
+    def delete_older_than(self, days: int) -> int:
+        date_cutoff = (dt.datetime.now() - dt.timedelta(days=days)).isoformat()
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM embeddings WHERE created_at < ?", (date_cutoff,)
+            )
+            self._connection.commit()
+        return cursor.rowcount
+
+
+def get_cache() -> Optional[EmbeddingsCache]:
+    """
+    :return: the embeddings cache for this process, or None if it is disabled (or can't be opened)
+    """
+    global _cache, _cache_pid
+    if not EMBEDDINGS_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if (_cache is None) or (_cache_pid != os.getpid()):
+            try:
+                _cache = EmbeddingsCache(EMBEDDINGS_CACHE_PATH)
+                _cache_pid = os.getpid()
+            except sqlite3.Error as e:
+                # not worth failing classification over
+                logger.warning(
+                    "Can't open embeddings cache at {}: {}".format(
+                        EMBEDDINGS_CACHE_PATH, e
+                    )
+                )
+                return None
+    return _cache
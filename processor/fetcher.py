@@ -1,11 +1,269 @@
 import collections
+import hashlib
 import logging
-from typing import Any, Callable, Dict, List, Optional
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import mcmetadata.urls as urls_lib
 import scrapy
 import scrapy.crawler as crawler
-from twisted.internet import defer, reactor
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http.headers import Headers
+from scrapy.utils.python import to_bytes
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from w3lib.http import headers_dict_to_raw
+
+from processor import base_dir
+
+logger = logging.getLogger(__name__)
+
+# how many processes to run content extraction in (defaults to one per core)
+EXTRACT_PROCESSES = int(os.environ.get("EXTRACT_PROCESSES", os.cpu_count() or 1))
+# how many pages can be waiting for extraction per process before we stop handing pages over (and so slow down parsing)
+EXTRACT_QUEUE_PER_PROCESS = int(os.environ.get("EXTRACT_QUEUE_PER_PROCESS", 2))
+# Extraction pools can be (re)started after the reactor, Scrapy and DB pool threads are running, and a forked child
+# can deadlock on a lock one of those threads held at the time, so the workers come from a fresh process instead
+EXTRACT_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# how many fetched stories iter_all_html lets pile up before the caller gets to them, before slowing down the crawl
+ITER_MAX_WAITING = int(os.environ.get("FETCH_ITER_MAX_WAITING", 100))
+
+# the same article is often found by more than one source on consecutive days, so we keep fetched pages on disk for a
+# while and reuse them instead of downloading them again (shared by all fetch runs on this machine)
+HTTP_CACHE_ENABLED = os.environ.get("HTTP_CACHE_ENABLED", "1") == "1"
+HTTP_CACHE_DIR = os.environ.get(
+    "HTTP_CACHE_DIR", os.path.join(base_dir, "files", "http-cache")
+)
+HTTP_CACHE_TTL_SECS = int(os.environ.get("HTTP_CACHE_TTL_SECS", 3 * 24 * 60 * 60))
+HTTP_CACHE_MAX_MB = int(os.environ.get("HTTP_CACHE_MAX_MB", 2048))
+
+
+class ContentExtractor:
+    """
+    Runs a CPU-heavy extraction function (like `mcmetadata.extract`) on fetched pages in a pool of processes, so that
+    parsing doesn't block the reactor (and all the downloads running in it). The number of pages waiting on the pool
+    is bounded; past that `extract` returns a Deferred that only starts once a slot frees up, which holds the
+    response in Scrapy and so slows down the crawl instead of piling up HTML in memory.
+    """
+
+    def __init__(
+        self,
+        extract: Callable[[str, str], Any],
+        processes: int = EXTRACT_PROCESSES,
+        queue_per_process: int = EXTRACT_QUEUE_PER_PROCESS,
+    ) -> None:
+        """
+        :param extract: called as extract(url, html) in a worker process, so it has to be a module-level function
+                        (its module is imported in the workers)
+        :param processes:
+        :param queue_per_process:
+        """
+        self._extract = extract
+        self._processes = processes
+        self._executor = self._new_executor()
+        # start the workers up front, so the first pages don't wait on them
+        self._executor.submit(int).result()
+        self._semaphore = defer.DeferredSemaphore(processes * queue_per_process)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context(EXTRACT_START_METHOD)
+        if EXTRACT_START_METHOD == "forkserver":
+            # import the extraction code once in the server (if it isn't running yet), rather than in every worker
+            context.set_forkserver_preload([self._extract.__module__])
+        return ProcessPoolExecutor(max_workers=self._processes, mp_context=context)
+
+    def extract(
+        self,
+        url: str,
+        content: str,
+        cancelled: Optional[Callable[[], bool]] = None,
+    ) -> defer.Deferred:
+        """
+        Returns a Deferred that fires (in the reactor thread) with the result of extract(url, content). If
+        `cancelled()` is true by the time the page gets a slot, it isn't extracted and fails with CancelledError.
+        """
+        return self._semaphore.run(
+            self._submit_unless_cancelled, url, content, cancelled
+        )
+
+    def _submit_unless_cancelled(
+        self, url: str, content: str, cancelled: Optional[Callable[[], bool]]
+    ) -> defer.Deferred:
+        if (cancelled is not None) and cancelled():
+            return defer.fail(defer.CancelledError())
+        return self._submit(url, content)
+
+    def _submit(self, url: str, content: str, retry: bool = True) -> defer.Deferred:
+        executor = self._executor
+        d = defer.Deferred()
+
+        def on_done(future: Future):
+            # called from the pool's management thread, so hand the result back over to the reactor
+            exception = future.exception()
+            if exception is not None:
+                reactor.callFromThread(d.errback, exception)
+            else:
+                reactor.callFromThread(d.callback, future.result())
+
+        try:
+            executor.submit(self._extract, url, content).add_done_callback(on_done)
+        except BrokenProcessPool as e:
+            d.errback(e)
+        if retry:
+            d.addErrback(self._retry_if_broken, executor, url, content)
+        return d
+
+    def _retry_if_broken(
+        self, failure, executor: ProcessPoolExecutor, url: str, content: str
+    ) -> defer.Deferred:
+        failure.trap(BrokenProcessPool)
+        # a worker died (OOM killed on a huge page, a crash in lxml...), which breaks the whole pool for good, so
+        # start a new one (just once for all the pages that were waiting on it) and try the page again
+        if self._executor is executor:
+            logger.warning(
+                "Extraction process died on {}, starting new processes".format(url)
+            )
+            self._executor = self._new_executor()
+            executor.shutdown(wait=False)
+        return self._submit(url, content, retry=False)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+class NormalizedUrlCacheStorage(FilesystemCacheStorage):
+    """
+    Scrapy's filesystem HTTP cache, keyed by the normalized URL instead of the request fingerprint, so the different
+    URLs sources give us for the same article share one entry. Entries are written to a temporary directory and
+    renamed into place, because more than one fetch process can be using the cache at the same time.
+    """
+
+    def _get_request_path(self, spider: scrapy.Spider, request: scrapy.Request) -> str:
+        key = hashlib.sha1(
+            to_bytes(urls_lib.normalize_url(request.url) or request.url)
+        ).hexdigest()
+        return str(Path(self.cachedir, spider.name, key[0:2], key))
+
+    def retrieve_response(self, spider: scrapy.Spider, request: scrapy.Request):
+        try:
+            return super().retrieve_response(spider, request)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # removed (or pruned) while we were reading it, so treat it as not cached
+            return None
+
+    def store_response(self, spider: scrapy.Spider, request: scrapy.Request, response):
+        rpath = Path(self._get_request_path(spider, request))
+        rpath.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=rpath.parent))
+        metadata = {
+            "url": request.url,
+            "method": request.method,
+            "status": response.status,
+            "response_url": response.url,
+            "timestamp": time.time(),
+        }
+        # only the parts retrieve_response reads
+        with self._open(temp_path / "response_headers", "wb") as f:
+            f.write(headers_dict_to_raw(Headers(response.headers)))
+        with self._open(temp_path / "response_body", "wb") as f:
+            f.write(response.body)
+        with self._open(temp_path / "pickled_meta", "wb") as f:
+            pickle.dump(metadata, f, protocol=4)
+        shutil.rmtree(rpath, ignore_errors=True)
+        try:
+            os.replace(temp_path, rpath)
+        except OSError:
+            # another process just stored this one too, so keep theirs
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def prune_response_cache(
+    cache_dir: str = HTTP_CACHE_DIR,
+    max_mb: int = HTTP_CACHE_MAX_MB,
+    ttl_secs: int = HTTP_CACHE_TTL_SECS,
+) -> int:
+    """
+    Deletes expired entries from the HTTP cache, and then the oldest ones until it fits in max_mb.
+    :return: the number of entries deleted
+    """
+    now = time.time()
+    entries = []  # (stored time, size, path)
+    deleted_count = 0
+    for entry_path in Path(cache_dir).glob("*/*/*"):
+        try:
+            stored = (entry_path / "pickled_meta").stat().st_mtime
+            size = sum(f.stat().st_size for f in entry_path.iterdir())
+        except OSError:
+            stored, size = (
+                entry_path.stat().st_mtime,
+                0,
+            )  # incomplete (or being written)
+        # left-over temporary directories only get cleaned up once they're clearly abandoned
+        if entry_path.name.startswith(".tmp-"):
+            if now - stored > 60 * 60:
+                shutil.rmtree(entry_path, ignore_errors=True)
+            continue
+        if 0 < ttl_secs < now - stored:
+            shutil.rmtree(entry_path, ignore_errors=True)
+            deleted_count += 1
+        else:
+            entries.append((stored, size, entry_path))
+    total_bytes = sum(size for _, size, _ in entries)
+    max_bytes = max_mb * 1024 * 1024
+    for _, size, entry_path in sorted(entries, key=lambda e: e[0]):
+        if total_bytes <= max_bytes:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_bytes -= size
+        deleted_count += 1
+    logger.info(
+        "Pruned {} entries from the HTTP cache, {:.1f} MB left".format(
+            deleted_count, total_bytes / (1024 * 1024)
+        )
+    )
+    return deleted_count
+
+
+# Twisted reactors can't be restarted, so we run one for the life of the process in a background thread and hand
+# crawls over to it (that way fetch_all_html can be called as many times as needed, including from Celery tasks)
+_reactor_thread: Optional[threading.Thread] = None
+# extraction pools are kept around between crawls too, one per extract function
+_extractors: Dict[Callable, ContentExtractor] = {}
+_fetcher_lock = threading.Lock()
+
+
+def _get_extractor(extract: Callable[[str, str], Any]) -> ContentExtractor:
+    with _fetcher_lock:
+        if extract not in _extractors:
+            _extractors[extract] = ContentExtractor(extract)
+        return _extractors[extract]
+
+
+def _start_reactor() -> None:
+    global _reactor_thread
+    with _fetcher_lock:
+        if _reactor_thread is None:
+            # signal handlers can only be installed from the main thread
+            _reactor_thread = threading.Thread(
+                target=reactor.run,
+                kwargs=dict(installSignalHandlers=False),
+                name="fetcher-reactor",
+                daemon=True,
+            )
+            _reactor_thread.start()
 
 
 class UrlSpider(scrapy.Spider):
@@ -13,7 +271,13 @@ class UrlSpider(scrapy.Spider):
 
     custom_settings: Dict[str, Any] = {
         "COOKIES_ENABLED": False,
-        # "HTTPCACHE_ENABLED": True,  # useful to have set True locally for repetative runs while debugging code changes
+        "HTTPCACHE_ENABLED": HTTP_CACHE_ENABLED,
+        "HTTPCACHE_DIR": HTTP_CACHE_DIR,
+        "HTTPCACHE_EXPIRATION_SECS": HTTP_CACHE_TTL_SECS,
+        "HTTPCACHE_STORAGE": "processor.fetcher.NormalizedUrlCacheStorage",
+        "HTTPCACHE_GZIP": True,
+        # don't hang on to errors, so we try those again next time
+        "HTTPCACHE_IGNORE_HTTP_CODES": list(range(400, 600)),
         "LOG_LEVEL": "INFO",
         "CONCURRENT_REQUESTS": 64,
         "CONCURRENT_REQUESTS_PER_DOMAIN": 5,
@@ -28,22 +292,26 @@ class UrlSpider(scrapy.Spider):
         handle_parse: Optional[Callable],
         start_urls: List[str],
         *args: List,
-        **kwargs: Dict
+        extractor: Optional[ContentExtractor] = None,
+        **kwargs: Dict,
     ) -> None:
         """
         Handle_parse will be called with a story:Dict object
         :param handle_parse:
         :param start_urls:
         :param args:
+        :param extractor: if set, the result of running it on the content is added to the story as `extracted`
+                          (instead of the `content`)
         :param kwargs:
         """
         super().__init__(*args, **kwargs)
         self.on_parse = handle_parse
         self.start_urls = start_urls
+        self.extractor = extractor
         logging.getLogger("scrapy").setLevel(logging.INFO)
         logging.getLogger("scrapy.core.engine").setLevel(logging.INFO)
 
-    def parse(self, response):
+    async def parse(self, response):
         # grab the original, undirected URL so we can relink later
         orig_url = (
             response.request.meta["redirect_urls"][0]
@@ -53,15 +321,40 @@ class UrlSpider(scrapy.Spider):
         story_data = dict(
             content=response.text, final_url=response.request.url, original_url=orig_url
         )
+        if self.extractor:
+            try:
+                story_data["extracted"] = await self.extractor.extract(
+                    orig_url,
+                    story_data.pop("content"),  # no need to hang on to the HTML
+                    # don't bother if the crawl has been stopped early in the meantime
+                    cancelled=lambda: not self.crawler.engine.running,
+                )
+            except defer.CancelledError:
+                return None
+            except Exception as e:
+                logger.warning(
+                    "Skipping story - failed to extract content from {} due to {}".format(
+                        orig_url, e
+                    )
+                )
+                return None
         if self.on_parse:
-            self.on_parse(story_data)
+            # it can return a Deferred to hold on to this response (and so slow down the crawl) until it is ready
+            await defer.maybeDeferred(self.on_parse, story_data)
         return None
 
 
-def run_spider(handle_parse: Callable, urls: List[str]) -> defer.Deferred:
+def run_spider(
+    handle_parse: Callable,
+    urls: List[str],
+    extractor: Optional[ContentExtractor] = None,
+    runner: Optional[crawler.CrawlerRunner] = None,
+) -> defer.Deferred:
     """Runs a spider for a batch of URLs and returns a deferred object:"""
-    runner = crawler.CrawlerRunner()
-    deferred = runner.crawl(UrlSpider, handle_parse=handle_parse, start_urls=urls)
+    runner = runner or crawler.CrawlerRunner()
+    deferred = runner.crawl(
+        UrlSpider, handle_parse=handle_parse, start_urls=urls, extractor=extractor
+    )
     return deferred
 
 
@@ -79,12 +372,18 @@ def group_urls_by_domain(urls: List[str]) -> List[List[str]]:
     return list(domain_groups.values())
 
 
-def fetch_all_html(
-    urls: List[str], handle_parse: Callable, num_spiders: int = 4
-) -> None:
-    """Splits URLs into batches and manages the concurrent execution of multiple spiders"""
-    if not urls:
-        return
+def _spider_runner(
+    urls: List[str],
+    handle_parse: Callable,
+    num_spiders: int,
+    extract: Optional[Callable[[str, str], Any]],
+) -> Tuple[Callable[[], defer.Deferred], Callable[[], defer.Deferred]]:
+    """
+    Sets up a crawl of all the URLs, returning functions to start it and to stop it early on the reactor thread. Both
+    return a Deferred, which fires once every URL has been tried (or the spiders have stopped).
+    """
+    if threading.current_thread() is _reactor_thread:
+        raise RuntimeError("Can't start a crawl from the reactor thread")
 
     # group URLs by domain
     domain_list = group_urls_by_domain(urls)
@@ -94,9 +393,121 @@ def fetch_all_html(
     for i, domain_urls in enumerate(domain_list):
         batches[i % num_spiders].extend(domain_urls)
 
-    # run spiders on the batches
-    deferreds = [run_spider(handle_parse, batch) for batch in batches if batch]
+    # set up the extraction pool here rather than on the reactor thread, so starting its processes doesn't hold up
+    # downloads
+    extractor = _get_extractor(extract) if extract else None
+    _start_reactor()
+
+    runners = []
+
+    def run_spiders() -> defer.Deferred:
+        # run spiders on the batches
+        deferreds = []
+        for batch in batches:
+            if batch:
+                runner = crawler.CrawlerRunner()
+                runners.append(runner)
+                deferreds.append(
+                    run_spider(handle_parse, batch, extractor, runner=runner)
+                )
+        return defer.DeferredList(deferreds)
+
+    def stop_spiders() -> defer.Deferred:
+        # the spiders drop the URLs they haven't got to yet, and finish the pages they're in the middle of
+        return defer.DeferredList([runner.stop() for runner in runners])
+
+    return run_spiders, stop_spiders
+
+
+def fetch_all_html(
+    urls: List[str],
+    handle_parse: Callable,
+    num_spiders: int = 4,
+    extract: Optional[Callable[[str, str], Any]] = None,
+) -> None:
+    """
+    Splits URLs into batches and manages the concurrent execution of multiple spiders
+    :param urls:
+    :param handle_parse: called with a story:Dict object for each page fetched
+    :param num_spiders:
+    :param extract: optional module-level function(url, html) to run on each page in a process pool; its result is
+                    passed to handle_parse as story["extracted"] instead of the story["content"] (pages it fails on
+                    are skipped)
+
+    Blocks until every URL has been tried. The crawl runs on the fetcher's reactor thread, so handle_parse is called
+    from that thread and this can't be called from inside handle_parse. It can be called as many times as you like.
+    """
+    if not urls:
+        return
+    run_spiders, _ = _spider_runner(urls, handle_parse, num_spiders, extract)
+    threads.blockingCallFromThread(reactor, run_spiders)
+
+
+def iter_all_html(
+    urls: List[str],
+    num_spiders: int = 4,
+    extract: Optional[Callable[[str, str], Any]] = None,
+    max_waiting: int = ITER_MAX_WAITING,
+) -> Iterator[Dict]:
+    """
+    Like fetch_all_html, but yields each story:Dict as soon as it has been fetched (and extracted), in the calling
+    thread, so callers can work on stories while the rest are still downloading. Once `max_waiting` stories are
+    waiting for the caller to get to them the spiders hold on to their responses, which slows down the crawl rather
+    than letting pages pile up in memory. If the caller stops iterating early the crawl is stopped too. Raises if the
+    crawl couldn't be run.
+    :param urls:
+    :param num_spiders:
+    :param extract: see fetch_all_html
+    :param max_waiting:
+    """
+    if not urls:
+        return
+    results = queue.Queue()
+    finished = object()  # put on the queue once the crawl is done
+    crawl_result = []  # what the crawl ended with (a Failure if it couldn't run)
+    waiting_slots = defer.DeferredSemaphore(max_waiting)
+    stopped = False  # if the caller stops early we stop the crawl, and drop the stories already on their way
+
+    def enqueue(story: Dict) -> defer.Deferred:
+        def put(_):
+            if stopped:
+                waiting_slots.release()
+            else:
+                results.put(story)
+
+        return waiting_slots.acquire().addCallback(put)
+
+    run_spiders, stop_spiders = _spider_runner(urls, enqueue, num_spiders, extract)
+
+    def start_spiders():
+        def done(result):
+            crawl_result.append(result)
+            results.put(finished)
+
+        defer.maybeDeferred(run_spiders).addBoth(done)
+
+    def stop() -> defer.Deferred:
+        nonlocal stopped
+        stopped = True
+        # stop the spiders first, so the pages we let go next don't lead to any more being fetched
+        spiders_stopped = stop_spiders()
+        if waiting_slots.waiting:
+            waiting_slots.release()  # each one that was waiting releases the next
+        return spiders_stopped
 
-    dl = defer.DeferredList(deferreds)
-    dl.addBoth(lambda _: reactor.stop())
-    reactor.run()
+    reactor.callFromThread(start_spiders)
+    done = False
+    try:
+        while True:
+            story = results.get()
+            if story is finished:
+                done = True
+                if isinstance(crawl_result[0], Failure):
+                    crawl_result[0].raiseException()
+                return
+            reactor.callFromThread(waiting_slots.release)
+            yield story
+    finally:
+        if not done:
+            # rather than letting it fetch (and extract) the rest of the URLs for nothing
+            threads.blockingCallFromThread(reactor, stop)
@@ -1,10 +1,11 @@
+import collections
 import datetime as dt
 import json
 import logging
 import os
 import sys
 import time
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import dateparser
 import pytz
@@ -207,7 +208,49 @@ def classify_stories(project: Dict, stories: List[Dict]) -> Dict[str, List[float
     :return: an array of confidence probabilities for this being a story about feminicide
     """
     classifier = classifiers.for_project(project)
-    return classifier.classify(stories)
+    return classifier.classify(stories, project)
+
+
+def classify_project_batches(
+    project_batches: List[Tuple[Dict, List[Dict]]]
+) -> List[Dict[str, List[float]]]:
+    """
+    Classify stories from many projects at once. Projects that use the same model get their stories combined into
+    one big batch, so we vectorize and predict once per model rather than once per project.
+    :param project_batches: a list of (project, stories) pairs
+    :return: a list of results (like `classify_stories` returns), in the same order as the `project_batches` passed in
+    """
+    # group the batches by which classifier they need
+    batch_indexes_by_model = collections.defaultdict(list)
+    for idx, (project, _) in enumerate(project_batches):
+        model_key = (project["language_model_id"], project["language"])
+        batch_indexes_by_model[model_key].append(idx)
+    results = [None] * len(project_batches)
+    for batch_indexes in batch_indexes_by_model.values():
+        first_project = project_batches[batch_indexes[0]][0]
+        combined_stories = [s for idx in batch_indexes for s in project_batches[idx][1]]
+        logger.debug(
+            "  classifying {} stories from {} projects with model {}".format(
+                len(combined_stories),
+                len(batch_indexes),
+                first_project["language_model_id"],
+            )
+        )
+        combined_results = classify_stories(first_project, combined_stories)
+        # now split the scores back out to each project
+        offset = 0
+        for idx in batch_indexes:
+            story_count = len(project_batches[idx][1])
+            results[idx] = {
+                key: (
+                    scores[offset : offset + story_count]
+                    if scores is not None
+                    else None
+                )
+                for key, scores in combined_results.items()
+            }
+            offset += story_count
+    return results
 
 
 def query_start_end_dates(
@@ -3,7 +3,7 @@ import logging
 import os
 import time
 from json.decoder import JSONDecodeError
-from typing import Dict, List
+from typing import Dict, List, Optional, Set
 
 import requests
 from sqlalchemy.orm.session import Session
@@ -46,11 +46,13 @@ ACCEPTED_ENTITY_TYPES = [
 
 
 def _add_confidence_to_stories(
-    session: Session, project: Dict, stories: List[Dict]
+    session: Session, project: Dict, stories: List[Dict], probs: Dict = None
 ) -> List[Dict]:
     if not stories:
         return stories
-    probs = projects.classify_stories(project, stories)
+    # scores might already have been computed as part of a bigger batch of projects
+    if probs is None:
+        probs = projects.classify_stories(project, stories)
     for idx, s in enumerate(stories):
         s["confidence"] = probs["model_scores"][idx]
         # adding in some extra stuff for logging only (they get removed in `prep_stories_for_posting`)
@@ -94,6 +96,70 @@ def add_entities_to_stories(stories: List[Dict]):
     return stories
 
 
+def _post_classified_stories(
+    session: Session,
+    project: Dict,
+    stories_with_confidence: List[Dict],
+    posted_ids: Optional[Set[int]] = None,
+) -> None:
+    """
+    :param posted_ids: if passed in, the `log_db_id` of each story is added as soon as the server accepts it (so if a
+                       later page fails the caller knows which ones not to send again)
+    """
+    for s in stories_with_confidence:
+        logger.debug(
+            "  classify: {}/{} - {}".format(
+                project["id"],
+                project["language_model_id"],
+                s["confidence"],
+            )
+        )
+    # only stories above project score threshold should be posted
+    stories_above_threshold = projects.remove_low_confidence_stories(
+        project.get("min_confidence", 0), stories_with_confidence
+    )
+    # pull out entities, if there is an env-var to a server set (only do this on above-threshold stories)
+    stories_with_entities = add_entities_to_stories(stories_above_threshold)
+    # remove data we aren't going to send to the server (and log)
+    stories_to_send = projects.prep_stories_for_posting(project, stories_with_entities)
+    if (
+        projects.LOG_LAST_POST_TO_FILE
+    ):  # helpful for debugging (the last project post will be written to a file)
+        with open(
+            os.path.join(
+                path_to_log_dir,
+                "{}-all-stories-{}.json".format(
+                    project["id"], time.strftime("%Y%m%d-%H%M%S")
+                ),
+            ),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            json.dump(stories_to_send, f, ensure_ascii=False, indent=4)
+    # mark the stories in the local DB that we intend to send
+    stories_db.update_stories_above_threshold(session, stories_to_send)
+    # now actually post them (in chunks just to make sure no single page is too big and causes a HTTP 413 error)
+    logger.info("{}: {} stories to post".format(project["id"], len(stories_to_send)))
+    for page_to_send in util.chunks(stories_to_send, 100):
+        projects.post_results(project, page_to_send)
+        if posted_ids is not None:
+            posted_ids.update(s["log_db_id"] for s in page_to_send)
+        for (
+            s
+        ) in (
+            page_to_send
+        ):  # for auditing, keep a log in the container of the results posted to main server
+            logger.debug(
+                "  post: {}/{} - {}".format(
+                    s["project_id"],
+                    s["language_model_id"],
+                    s["confidence"],
+                )
+            )
+        # and track that we posted the stories that we did in our local debug DB
+        stories_db.update_stories_posted_date(session, page_to_send)
+
+
 @app.task(serializer="json", bind=True)
 def classify_and_post_worker(self, project: Dict, stories: List[Dict]):
     """
@@ -112,6 +178,7 @@ def classify_and_post_worker(self, project: Dict, stories: List[Dict]):
                     * `url`: the full URL of the story
 
     """
+    posted_ids = set()
     try:
         logger.debug(
             "{}: classify {} stories (model {})".format(
@@ -132,67 +199,17 @@ def classify_and_post_worker(self, project: Dict, stories: List[Dict]):
             stories_with_confidence = _add_confidence_to_stories(
                 session, project, stories
             )
-            for s in stories_with_confidence:
-                logger.debug(
-                    "  classify: {}/{} - {}".format(
-                        project["id"],
-                        project["language_model_id"],
-                        s["confidence"],
-                    )
-                )
-            # only stories above project score threshold should be posted
-            stories_above_threshold = projects.remove_low_confidence_stories(
-                project.get("min_confidence", 0), stories_with_confidence
-            )
-            # pull out entities, if there is an env-var to a server set (only do this on above-threshold stories)
-            stories_with_entities = add_entities_to_stories(stories_above_threshold)
-            # remove data we aren't going to send to the server (and log)
-            stories_to_send = projects.prep_stories_for_posting(
-                project, stories_with_entities
+            _post_classified_stories(
+                session, project, stories_with_confidence, posted_ids
             )
-            if (
-                projects.LOG_LAST_POST_TO_FILE
-            ):  # helpful for debugging (the last project post will be written to a file)
-                with open(
-                    os.path.join(
-                        path_to_log_dir,
-                        "{}-all-stories-{}.json".format(
-                            project["id"], time.strftime("%Y%m%d-%H%M%S")
-                        ),
-                    ),
-                    "w",
-                    encoding="utf-8",
-                ) as f:
-                    json.dump(stories_to_send, f, ensure_ascii=False, indent=4)
-            # mark the stories in the local DB that we intend to send
-            stories_db.update_stories_above_threshold(session, stories_to_send)
-            # now actually post them (in chunks just to make sure no single page is too big and causes a HTTP 413 error)
-            logger.info(
-                "{}: {} stories to post".format(project["id"], len(stories_to_send))
-            )
-            for page_to_send in util.chunks(stories_to_send, 100):
-                projects.post_results(project, page_to_send)
-                for (
-                    s
-                ) in (
-                    page_to_send
-                ):  # for auditing, keep a log in the container of the results posted to main server
-                    logger.debug(
-                        "  post: {}/{} - {}".format(
-                            s["project_id"],
-                            s["language_model_id"],
-                            s["confidence"],
-                        )
-                    )
-                # and track that we posted the stories that we did in our local debug DB
-                stories_db.update_stories_posted_date(session, page_to_send)
     except requests.exceptions.HTTPError as err:
-        # on failure requeue to try again
+        # on failure requeue to try again (but only with the stories the server didn't already accept)
+        unposted_stories = [s for s in stories if s.get("log_db_id") not in posted_ids]
         logger.warning(
-            "{}: Failed to post {} results".format(project["id"], len(stories))
+            "{}: Failed to post {} results".format(project["id"], len(unposted_stories))
         )
         # logger.exception(err) #Sentry logging ignored
-        raise self.retry(exc=err)
+        raise self.retry(exc=err, args=(project, unposted_stories))
     except Exception as exc:
         # only failure here is the classifier not loading? probably we should try again... feminicide server holds state
         logger.warning(
@@ -200,3 +217,53 @@ def classify_and_post_worker(self, project: Dict, stories: List[Dict]):
         )
         logger.exception(exc)
         raise self.retry(exc=exc)
+
+
+@app.task(serializer="json", bind=True)
+def classify_and_post_batch_worker(self, project_batches: List[Dict]):
+    """
+    Like `classify_and_post_worker`, but for pages of stories from many projects at once. Projects that share a model
+    are classified together in one pass, then results are posted separately for each project.
+    :param self:
+    :param project_batches: a list of dicts, each with a `project` and its `stories` (see `classify_and_post_worker`)
+    """
+    project_batches = [b for b in project_batches if b["stories"]]
+    if not project_batches:
+        return
+    try:
+        all_probs = projects.classify_project_batches(
+            [(b["project"], b["stories"]) for b in project_batches]
+        )
+    except Exception as exc:
+        logger.warning(
+            "Failed to label stories for {} projects".format(len(project_batches))
+        )
+        logger.exception(exc)
+        raise self.retry(exc=exc)
+    Session = database.get_session_maker()
+    with Session() as session:
+        for batch, probs in zip(project_batches, all_probs):
+            project, stories = batch["project"], batch["stories"]
+            posted_ids = set()
+            try:
+                stories_with_confidence = _add_confidence_to_stories(
+                    session, project, stories, probs
+                )
+                _post_classified_stories(
+                    session, project, stories_with_confidence, posted_ids
+                )
+            except Exception as exc:
+                # hand this project off to the single-project task, so it gets retried on its own without
+                # re-posting stories for all the other projects in this batch (or the pages of this project's stories
+                # the server already accepted)
+                unposted_stories = [
+                    s for s in stories if s.get("log_db_id") not in posted_ids
+                ]
+                logger.warning(
+                    "{}: Failed to post {} results, requeueing ({})".format(
+                        project["id"], len(unposted_stories), exc
+                    )
+                )
+                session.rollback()
+                if unposted_stories:
+                    classify_and_post_worker.delay(project, unposted_stories)
@@ -1,15 +1,55 @@
+import logging
+
+from celery import signals
 from celery.schedules import crontab
 
 import processor.database as database
+import processor.embeddings_cache as embeddings_cache
 from processor.celery import app
-from processor.database.stories_db import delete_old_stories
+from processor.database.stories_db import (
+    compact_story_counts,
+    create_story_partitions,
+    delete_old_stories,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @app.task(name="processor.tasks.delete_old_data.delete_old_stories_task")
 def delete_old_stories_task(age: int = 62):
     Session = database.get_session_maker()
     with Session() as session:
+        # a good time to make sure the partitions for the next few weeks exist too (but old stories still need
+        # deleting if that fails; new stories just go in the default partition until it works)
+        try:
+            create_story_partitions(session)
+        except Exception as e:
+            logger.exception(e)
+            session.rollback()
         delete_old_stories(session, age)
+        # deleting added even more +/- rows to the dashboard counts, so tidy them up
+        compact_story_counts(session)
+
+
+@app.task(name="processor.tasks.delete_old_data.delete_old_embeddings_task")
+def delete_old_embeddings_task(
+    age: int = embeddings_cache.EMBEDDINGS_CACHE_MAX_AGE_DAYS,
+):
+    # NB: the cache is a file on each host, so this only prunes the one on whichever worker runs it
+    cache = embeddings_cache.get_cache()
+    if cache:
+        deleted = cache.delete_older_than(age)
+        logger.info("Deleted {} old cached embeddings".format(deleted))
+
+
+@signals.worker_ready.connect
+def delete_old_embeddings_on_startup(**kwargs):
+    # so every host's cache gets pruned, not just the one the scheduled task happens to land on
+    try:
+        delete_old_embeddings_task(embeddings_cache.EMBEDDINGS_CACHE_MAX_AGE_DAYS)
+    except Exception as e:
+        # not worth failing to start over
+        logger.exception(e)
 
 
 app.conf.beat_schedule.update(
@@ -19,5 +59,10 @@ app.conf.beat_schedule.update(
             "schedule": crontab(day_of_week="*", hour="0", minute="0"),
             "args": (30,),
         },
+        "delete_old_embeddings_task": {
+            "task": "processor.tasks.delete_old_data.delete_old_embeddings_task",
+            "schedule": crontab(day_of_week="*", hour="0", minute="30"),
+            "args": (embeddings_cache.EMBEDDINGS_CACHE_MAX_AGE_DAYS,),
+        },
     }
 )
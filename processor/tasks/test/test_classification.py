@@ -1,6 +1,9 @@
 import json
 import os
 import unittest
+from unittest.mock import patch
+
+import requests
 
 import processor.database as database
 import processor.tasks.classification as classification
@@ -68,5 +71,70 @@ class TestClassification(unittest.TestCase):
             assert "entities" in s
 
 
+def _classified_page(project, count):
+    stories = [
+        dict(
+            log_db_id=idx,
+            source=SOURCE_MEDIA_CLOUD,
+            language="en",
+            media_url="example.com",
+            media_name="Example",
+            publish_date=None,
+            title="Story {}".format(idx),
+            url="https://example.com/{}".format(idx),
+            story_text="story number {}".format(idx),
+        )
+        for idx in range(count)
+    ]
+    probs = dict(model_scores=[0.9] * count, model_1_scores=None, model_2_scores=None)
+    return stories, probs
+
+
+@patch("processor.tasks.classification.entities.server_address_set", return_value=False)
+@patch("processor.tasks.classification.stories_db")
+@patch("processor.tasks.classification.database")
+class TestPostingFailures(unittest.TestCase):
+    @patch("processor.tasks.classification.classify_and_post_worker")
+    @patch("processor.tasks.classification.projects.post_results")
+    @patch("processor.tasks.classification.projects.classify_project_batches")
+    def test_batch_requeues_only_unposted(
+        self, mock_classify, mock_post_results, mock_worker, *_
+    ):
+        project = dict(TEST_EN_PROJECT, min_confidence=0)
+        stories, probs = _classified_page(project, 250)
+        mock_classify.return_value = [probs]
+        # the first page (of 100) goes through, then the server falls over
+        mock_post_results.side_effect = [None, RuntimeError("server error")]
+        classification.classify_and_post_batch_worker(
+            [dict(project=project, stories=stories)]
+        )
+        mock_worker.delay.assert_called_once()
+        requeued_project, requeued_stories = mock_worker.delay.call_args[0]
+        assert requeued_project == project
+        assert [s["log_db_id"] for s in requeued_stories] == list(range(100, 250))
+
+    @patch("processor.tasks.classification.projects.post_results")
+    @patch("processor.tasks.classification.projects.classify_stories")
+    def test_retry_only_unposted(self, mock_classify_stories, mock_post_results, *_):
+        project = dict(TEST_EN_PROJECT, min_confidence=0)
+        stories, probs = _classified_page(project, 150)
+        mock_classify_stories.return_value = probs
+        mock_post_results.side_effect = [
+            None,
+            requests.exceptions.HTTPError("503 Server Error"),
+        ]
+        with (
+            patch.object(
+                classification.classify_and_post_worker,
+                "retry",
+                side_effect=RuntimeError("retrying"),
+            ) as mock_retry,
+            self.assertRaises(RuntimeError),
+        ):
+            classification.classify_and_post_worker(project, stories)
+        _, retry_stories = mock_retry.call_args[1]["args"]
+        assert [s["log_db_id"] for s in retry_stories] == list(range(100, 150))
+
+
 if __name__ == "__main__":
     unittest.main()
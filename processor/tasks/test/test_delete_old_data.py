@@ -0,0 +1,40 @@
+import unittest
+from unittest.mock import patch
+
+from processor.tasks import delete_old_data
+
+
+class TestDeleteOldStories(unittest.TestCase):
+    @patch("processor.tasks.delete_old_data.compact_story_counts")
+    @patch("processor.tasks.delete_old_data.delete_old_stories")
+    @patch("processor.tasks.delete_old_data.create_story_partitions")
+    @patch("processor.tasks.delete_old_data.database")
+    def test_partition_failure_still_deletes(
+        self,
+        mock_database,
+        mock_create_story_partitions,
+        mock_delete_old_stories,
+        mock_compact_story_counts,
+    ):
+        mock_create_story_partitions.side_effect = RuntimeError("overlapping rows")
+        delete_old_data.delete_old_stories_task(30)
+        session = (
+            mock_database.get_session_maker.return_value.return_value.__enter__.return_value
+        )
+        session.rollback.assert_called_once()
+        mock_delete_old_stories.assert_called_once_with(session, 30)
+        mock_compact_story_counts.assert_called_once_with(session)
+
+
+class TestDeleteOldEmbeddings(unittest.TestCase):
+    @patch("processor.tasks.delete_old_data.embeddings_cache.get_cache")
+    def test_prunes_on_startup(self, mock_get_cache):
+        # each host has its own cache, so each worker prunes it when it starts
+        delete_old_data.delete_old_embeddings_on_startup(sender=None)
+        mock_get_cache.return_value.delete_older_than.assert_called_once_with(
+            delete_old_data.embeddings_cache.EMBEDDINGS_CACHE_MAX_AGE_DAYS
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
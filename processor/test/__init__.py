@@ -1,10 +1,18 @@
 import json
 import os
+import tempfile
 
+import processor.embeddings_cache as embeddings_cache
 from processor import base_dir
 
 test_fixture_dir = os.path.join(base_dir, "processor", "test", "fixtures")
 
+# tests shouldn't read from (or fill up) the real embeddings cache - a cached vector would hide problems computing it
+_embeddings_cache_dir = tempfile.TemporaryDirectory()
+embeddings_cache.EMBEDDINGS_CACHE_PATH = os.path.join(
+    _embeddings_cache_dir.name, "embeddings-cache.db"
+)
+
 
 def sample_stories():
     # this loads read data from a real request from a log file on the real server
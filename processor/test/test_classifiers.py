@@ -1,8 +1,23 @@
+import hashlib
 import json
 import os
+import pickle
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
 import unittest
+from collections import OrderedDict
+from typing import Dict
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
 
 import processor.classifiers as classifiers
+import processor.embeddings_cache as embeddings_cache
 from processor.test import test_fixture_dir
 from processor.test.test_projects import TEST_EN_PROJECT
 
@@ -18,6 +33,244 @@ class TestModelList(unittest.TestCase):
             assert p["filename_prefix"] is not None
 
 
+def _mock_response(status_code: int = 200, blocks=None, headers=None):
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.iter_content.return_value = blocks or []
+    return response
+
+
+class TestModelListCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, classifiers.MODEL_LIST_FILENAME)
+        self._write([dict(id=1, name="usa"), dict(id=2, name="uruguay")])
+        patcher = patch.object(classifiers, "CONFIG_DIR", self._dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        classifiers.clear_model_list_cache()
+        self.addCleanup(classifiers.clear_model_list_cache)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _write(self, model_list, mtime_ns=None):
+        with open(self.path, "w") as f:
+            json.dump(model_list, f)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    @patch("processor.classifiers.json.load", wraps=json.load)
+    def test_cache_hit(self, mock_json_load):
+        assert classifiers._model_index()[2]["name"] == "uruguay"
+        assert [m["id"] for m in classifiers.get_model_list()] == [1, 2]
+        assert classifiers._model_index()[1]["name"] == "usa"
+        mock_json_load.assert_called_once()
+
+    @patch("processor.classifiers.json.load", wraps=json.load)
+    def test_invalidation(self, mock_json_load):
+        assert sorted(classifiers._model_index().keys()) == [1, 2]
+        # re-read if the file changes...
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        self._write([dict(id=3, name="kenya")], mtime_ns + 1_000_000_000)
+        assert sorted(classifiers._model_index().keys()) == [3]
+        assert mock_json_load.call_count == 2
+        # ...or when asked to
+        classifiers.clear_model_list_cache()
+        assert sorted(classifiers._model_index().keys()) == [3]
+        assert mock_json_load.call_count == 3
+
+
+class TestDownloadFile(unittest.TestCase):
+    URL = "https://example.com/models/usa_model.p"
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.dest_dir = self._temp_dir.name
+        self.local_path = os.path.join(self.dest_dir, "usa_1_model.p")
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _previous_download(self, contents: bytes) -> dict:
+        with open(self.local_path, "wb") as f:
+            f.write(contents)
+        return {
+            "usa_1_model.p": dict(
+                url=self.URL,
+                etag='"abc"',
+                last_modified=None,
+                sha256=hashlib.sha256(contents).hexdigest(),
+            )
+        }
+
+    def _temp_files(self):
+        return [f for f in os.listdir(self.dest_dir) if f.endswith(".tmp")]
+
+    @patch("processor.classifiers.requests.get")
+    def test_new_file(self, mock_get):
+        mock_get.return_value = _mock_response(
+            blocks=[b"new ", b"model"], headers={"ETag": '"abc"'}
+        )
+        filename, entry, changed = classifiers._download_file(
+            self.URL, self.dest_dir, "usa_1", {}
+        )
+        assert filename == "usa_1_model.p"
+        assert changed is True
+        assert entry["etag"] == '"abc"'
+        assert entry["sha256"] == hashlib.sha256(b"new model").hexdigest()
+        with open(self.local_path, "rb") as f:
+            assert f.read() == b"new model"
+        # the usual permissions, not the owner-only ones of a temp file
+        assert stat.S_IMODE(os.stat(self.local_path).st_mode) == (
+            classifiers.DOWNLOADED_FILE_MODE
+        )
+        assert classifiers.DOWNLOADED_FILE_MODE & stat.S_IRUSR
+        # nothing conditional to ask for the first time
+        assert mock_get.call_args.kwargs["headers"] == {}
+        assert self._temp_files() == []
+
+    @patch("processor.classifiers.requests.get")
+    def test_not_modified(self, mock_get):
+        manifest = self._previous_download(b"old model")
+        mock_get.return_value = _mock_response(status_code=304)
+        filename, entry, changed = classifiers._download_file(
+            self.URL, self.dest_dir, "usa_1", manifest
+        )
+        assert changed is False
+        assert entry == manifest["usa_1_model.p"]
+        assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+        with open(self.local_path, "rb") as f:
+            assert f.read() == b"old model"
+
+    @patch("processor.classifiers.requests.get")
+    def test_same_contents(self, mock_get):
+        # a server that ignores conditional requests sends the whole (unchanged) file again
+        manifest = self._previous_download(b"old model")
+        mock_get.return_value = _mock_response(blocks=[b"old model"])
+        mtime = os.path.getmtime(self.local_path)
+        _, _, changed = classifiers._download_file(
+            self.URL, self.dest_dir, "usa_1", manifest
+        )
+        assert changed is False
+        assert os.path.getmtime(self.local_path) == mtime
+        assert self._temp_files() == []
+
+    @patch("processor.classifiers.requests.get")
+    def test_changed_contents(self, mock_get):
+        manifest = self._previous_download(b"old model")
+        mock_get.return_value = _mock_response(blocks=[b"better model"])
+        _, entry, changed = classifiers._download_file(
+            self.URL, self.dest_dir, "usa_1", manifest
+        )
+        assert changed is True
+        assert entry["sha256"] == hashlib.sha256(b"better model").hexdigest()
+        with open(self.local_path, "rb") as f:
+            assert f.read() == b"better model"
+        assert self._temp_files() == []
+
+    @patch("processor.classifiers.requests.get")
+    def test_failed_download(self, mock_get):
+        manifest = self._previous_download(b"old model")
+
+        def broken_stream(chunk_size):
+            yield b"half a "
+            raise ConnectionError("connection reset")
+
+        response = _mock_response()
+        response.iter_content.side_effect = broken_stream
+        mock_get.return_value = response
+        with self.assertRaises(ConnectionError):
+            classifiers._download_file(self.URL, self.dest_dir, "usa_1", manifest)
+        # the old file is left alone, and the partial download is cleaned up
+        with open(self.local_path, "rb") as f:
+            assert f.read() == b"old model"
+        assert self._temp_files() == []
+
+    @patch("processor.classifiers.requests.get")
+    @patch("processor.classifiers.update_model_list")
+    def test_download_models_saves_manifest(self, mock_update_model_list, mock_get):
+        mock_update_model_list.return_value = [
+            dict(
+                id=1,
+                name="usa",
+                filename_prefix="usa",
+                model_1_files=[self.URL],
+                model_2_files=[],
+            )
+        ]
+        with patch.object(classifiers, "MODEL_DIR", self.dest_dir):
+            mock_get.return_value = _mock_response(
+                blocks=[b"model"], headers={"ETag": '"v1"'}
+            )
+            assert classifiers.download_models() is True
+            # the next time we ask only for changes
+            mock_get.return_value = _mock_response(status_code=304)
+            assert classifiers.download_models() is True
+            assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+            with open(
+                os.path.join(self.dest_dir, classifiers.DOWNLOAD_MANIFEST_FILENAME)
+            ) as f:
+                assert json.load(f)["usa_1_model.p"]["etag"] == '"v1"'
+
+
+def _fake_embeddings_model(texts):
+    return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+class TestEmbed(unittest.TestCase):
+    @patch("processor.classifiers.embeddings_cache.get_cache")
+    def test_broken_cache(self, mock_get_cache):
+        # a cache that can't be used shouldn't stop us from computing the embeddings
+        cache = MagicMock()
+        cache.get_many.side_effect = sqlite3.OperationalError("database is locked")
+        cache.put_many.side_effect = sqlite3.OperationalError("database is locked")
+        mock_get_cache.return_value = cache
+        vectors = classifiers._embed(
+            _fake_embeddings_model, "embeddings-en", ["one", "three"]
+        )
+        assert vectors.tolist() == [[3.0, 1.0], [5.0, 1.0]]
+
+    def test_model_version(self):
+        # a re-downloaded model has the same name, but mustn't get the old model's cached vectors
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, "embeddings-en")
+            os.mkdir(model_path)
+            with open(os.path.join(model_path, "saved_model.pb"), "wb") as f:
+                f.write(b"version 1")
+            v1 = classifiers.embeddings_model_version(model_path)
+            assert v1.startswith("embeddings-en@")
+            with open(os.path.join(model_path, "saved_model.pb"), "wb") as f:
+                f.write(b"version two")
+            assert classifiers.embeddings_model_version(model_path) != v1
+
+
+class TestEmbeddingsBatches(unittest.TestCase):
+    @patch("processor.classifiers.embeddings_cache.get_cache", return_value=None)
+    def test_embed_in_batches(self, mock_get_cache):
+        batch_sizes = []
+
+        def embeddings_model(texts):
+            batch_sizes.append(len(texts))
+            return _fake_embeddings_model(texts)
+
+        texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+        with patch.object(classifiers, "EMBEDDINGS_BATCH_SIZE", 2):
+            vectors = classifiers._embed(embeddings_model, "embeddings-en", texts)
+        assert batch_sizes == [2, 2, 1]
+        assert vectors.tolist() == _fake_embeddings_model(texts).tolist()
+
+    def test_truncate(self):
+        with patch.object(classifiers, "MAX_STORY_TEXT_CHARS", 5):
+            assert classifiers._truncate("a long story") == "a lon"
+            assert classifiers._truncate("short") == "short"
+            assert classifiers._truncate(None) is None
+        with patch.object(classifiers, "MAX_STORY_TEXT_CHARS", 0):
+            assert classifiers._truncate("a long story") == "a long story"
+
+
 class TestClassifierHelpers(unittest.TestCase):
     def test_classifier_for_project(self):
         p = TEST_EN_PROJECT.copy()
@@ -31,6 +284,157 @@ class TestClassifierHelpers(unittest.TestCase):
         assert c.model_name() == "aapf"
 
 
+class TestClassifierCache(unittest.TestCase):
+    def test_reuses_loaded_classifier(self):
+        classifiers.clear_classifier_cache()
+        p = TEST_EN_PROJECT.copy()
+        c1 = classifiers.for_project(p)
+        c2 = classifiers.for_project(p)
+        assert c1 is c2
+        p["language_model_id"] = 2
+        c3 = classifiers.for_project(p)
+        assert c3 is not c1
+        classifiers.clear_classifier_cache()
+        c4 = classifiers.for_project(TEST_EN_PROJECT.copy())
+        assert c4 is not c1
+
+    def test_reloads_changed_files(self):
+        classifiers.clear_classifier_cache()
+        c1 = classifiers.for_project(TEST_EN_PROJECT.copy())
+        model_file = c1._path_to_file("1_model")
+        stat = os.stat(model_file)
+        os.utime(model_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        c2 = classifiers.for_project(TEST_EN_PROJECT.copy())
+        assert c1 is not c2
+
+    def test_shared_embeddings_model(self):
+        m1 = classifiers.load_embeddings_model(classifiers.TFHUB_MODEL_PATH_EN)
+        m2 = classifiers.load_embeddings_model(classifiers.TFHUB_MODEL_PATH_EN)
+        assert m1 is m2
+
+
+_TFIDF_MODEL_CONFIG = dict(id=1, vectorizer_type_1="tfidf", chained_models=False)
+_EMBEDDINGS_MODEL_CONFIG = dict(
+    id=2, vectorizer_type_1="embeddings", chained_models=False
+)
+
+
+class _FakeClassifier:
+    # stands in for a Classifier, but doesn't load anything (and can be made to take a while to "load")
+    loading: Dict[int, threading.Event] = {}
+
+    def __init__(self, model_config, language):
+        self.config = model_config
+        self.language = language
+        self.estimated_size = 0
+        release = self.loading.get(model_config["id"])
+        if release is not None:
+            assert release.wait(5)
+
+    def is_stale(self):
+        return False
+
+
+@patch.object(classifiers, "Classifier", _FakeClassifier)
+@patch.object(
+    classifiers,
+    "_model_index",
+    lambda: {1: _TFIDF_MODEL_CONFIG, 2: _EMBEDDINGS_MODEL_CONFIG},
+)
+class TestClassifierCacheKeys(unittest.TestCase):
+    def setUp(self):
+        classifiers.clear_classifier_cache()
+        _FakeClassifier.loading = {}
+
+    def tearDown(self):
+        classifiers.clear_classifier_cache()
+
+    def test_shared_across_projects(self):
+        c1 = classifiers.for_project(dict(id=10, language="es", language_model_id=1))
+        c2 = classifiers.for_project(dict(id=11, language="pt", language_model_id=1))
+        # TF-IDF models don't depend on language, and don't remember which project loaded them
+        assert c1 is c2
+        assert c1.language is None
+        assert not hasattr(c1, "project")
+        # but embeddings models do depend on it
+        c3 = classifiers.for_project(dict(id=10, language="en", language_model_id=2))
+        c4 = classifiers.for_project(dict(id=11, language="ko", language_model_id=2))
+        assert c3 is not c4
+        assert (c3.language, c4.language) == ("en", "ko")
+
+    def test_slow_load_doesnt_block_others(self):
+        release = threading.Event()
+        _FakeClassifier.loading[1] = release
+        slow_results = []
+
+        def load_slow():
+            slow_results.append(
+                classifiers.for_project(dict(id=10, language="en", language_model_id=1))
+            )
+
+        slow_loaders = [threading.Thread(target=load_slow) for _ in range(2)]
+        for t in slow_loaders:
+            t.start()
+        try:
+            # model 1 is still loading, but model 2 can be loaded in the meantime
+            c2 = classifiers.for_project(
+                dict(id=11, language="en", language_model_id=2)
+            )
+            assert c2.config["id"] == 2
+            assert slow_results == []
+        finally:
+            release.set()
+            for t in slow_loaders:
+                t.join()
+        # and both threads waiting on model 1 get the same one
+        assert len(slow_results) == 2
+        assert slow_results[0] is slow_results[1]
+
+
+class TestTfidfRowCache(unittest.TestCase):
+    def setUp(self):
+        self.vectorizer = TfidfVectorizer().fit(_CHAINED_TEXTS)
+        patcher = patch.object(classifiers, "_tfidf_rows", OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _transform(self, texts):
+        return classifiers._tfidf_transform(self.vectorizer, "digest", texts)
+
+    def test_same_as_vectorizer(self):
+        self._transform(_CHAINED_TEXTS[:2])
+        # some cached, some not, and some repeated within the batch
+        texts = [
+            _CHAINED_TEXTS[1],
+            _CHAINED_TEXTS[3],
+            _CHAINED_TEXTS[3],
+            _CHAINED_TEXTS[0],
+            "something new entirely",
+            _CHAINED_TEXTS[1],
+        ]
+        matrix = self._transform(texts)
+        expected = self.vectorizer.transform(texts)
+        assert matrix.shape == expected.shape
+        assert (matrix != expected).nnz == 0
+        # and again, now that they're all cached
+        assert (self._transform(texts) != expected).nnz == 0
+
+    def test_eviction(self):
+        with patch.object(classifiers, "TFIDF_CACHE_SIZE", 3):
+            self._transform(_CHAINED_TEXTS[:2])
+            self._transform(_CHAINED_TEXTS[2:])
+            assert len(classifiers._tfidf_rows) == 3
+            # the least recently used ones went first
+            assert list(classifiers._tfidf_rows.keys()) == [
+                ("digest", embeddings_cache.text_hash(t)) for t in _CHAINED_TEXTS[2:]
+            ]
+            # a batch bigger than the cache still gets all its rows
+            texts = _CHAINED_TEXTS + ["one more"]
+            matrix = self._transform(texts)
+            assert (matrix != self.vectorizer.transform(texts)).nnz == 0
+            assert len(classifiers._tfidf_rows) == 3
+
+
 class TestChainedClassifers(unittest.TestCase):
     def test_multiplied(self):
         project = TEST_EN_PROJECT.copy()
@@ -51,6 +455,104 @@ class TestChainedClassifers(unittest.TestCase):
         assert round(results["model_scores"][1], 5) == 0.01917
 
 
+_CHAINED_TEXTS = [
+    "a",
+    "a short one",
+    "a story of middling length",
+    "a long story about something or other",
+    "a very long story that goes on and on about something or other for quite a while",
+]
+
+
+class TestChainedSharedVectorizers(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.embeddings_path = os.path.join(self._dir.name, "embeddings-en")
+        os.mkdir(self.embeddings_path)
+        with open(os.path.join(self.embeddings_path, "saved_model.pb"), "wb") as f:
+            f.write(b"graph")
+        for name, value in [
+            ("MODEL_DIR", self._dir.name),
+            ("TFHUB_MODEL_PATH_EN", self.embeddings_path),
+        ]:
+            patcher = patch.object(classifiers, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(
+            classifiers.embeddings_cache, "get_cache", return_value=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        labels = [0, 0, 1, 1, 1]
+        vectors = _fake_embeddings_model(_CHAINED_TEXTS)
+        self._pickle("1_model", LogisticRegression().fit(vectors, labels))
+        self._pickle("2_model", LogisticRegression(C=0.1).fit(vectors, labels))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _pickle(self, name, obj):
+        with open(os.path.join(self._dir.name, "chained_" + name + ".p"), "wb") as f:
+            pickle.dump(obj, f)
+
+    def _config(self, vectorizer_type):
+        return dict(
+            id=99,
+            filename_prefix="chained",
+            chained_models=True,
+            model_1="lr",
+            model_2="lr",
+            vectorizer_type_1=vectorizer_type,
+            vectorizer_type_2=vectorizer_type,
+        )
+
+    def test_embeddings_model_loaded_once(self):
+        embeddings_model = MagicMock(side_effect=_fake_embeddings_model)
+        fake_hub = MagicMock()
+        fake_hub.load.return_value = embeddings_model
+        stories = [dict(story_text=t) for t in _CHAINED_TEXTS]
+        with (
+            patch.dict(classifiers._embeddings_models, clear=True),
+            patch.dict(
+                sys.modules,
+                {"tensorflow_hub": fake_hub, "tensorflow_text": MagicMock()},
+            ),
+        ):
+            classifier = classifiers.Classifier(self._config("embeddings"), "en")
+            fake_hub.load.assert_called_once_with(self.embeddings_path)
+            assert classifier._vectorizer_2 is classifier._vectorizer_1
+            results = classifier.classify(stories)
+            # both stages used the one set of embeddings
+            assert embeddings_model.call_count == 1
+            # same scores as when each stage has its own (identical) embeddings model
+            separate = classifiers.Classifier(self._config("embeddings"), "en")
+            separate._vectorizer_2 = MagicMock(side_effect=_fake_embeddings_model)
+            separate_results = separate.classify(stories)
+        assert separate._vectorizer_2.call_count == 1
+        for scores in ["model_1_scores", "model_2_scores", "model_scores"]:
+            assert np.allclose(results[scores], separate_results[scores])
+
+    def test_tfidf_vectorizer_loaded_once(self):
+        # two separately pickled, but identical, vectorizers
+        vectorizer = TfidfVectorizer().fit(_CHAINED_TEXTS)
+        self._pickle("1_vectorizer", vectorizer)
+        self._pickle("2_vectorizer", vectorizer)
+        labels = [0, 0, 1, 1, 1]
+        tfidf_vectors = vectorizer.transform(_CHAINED_TEXTS)
+        model_1 = LogisticRegression().fit(tfidf_vectors, labels)
+        model_2 = LogisticRegression(C=0.1).fit(tfidf_vectors, labels)
+        self._pickle("1_model", model_1)
+        self._pickle("2_model", model_2)
+        classifier = classifiers.Classifier(self._config("tfidf"), None)
+        assert classifier._vectorizer_2 is classifier._vectorizer_1
+        results = classifier.classify([dict(story_text=t) for t in _CHAINED_TEXTS])
+        expected_1 = model_1.predict_proba(tfidf_vectors)[:, 1]
+        expected_2 = model_2.predict_proba(tfidf_vectors)[:, 1]
+        assert np.allclose(results["model_1_scores"], expected_1)
+        assert np.allclose(results["model_2_scores"], expected_2)
+        assert np.allclose(results["model_scores"], expected_1 * expected_2)
+
+
 class TestClassifierResults(unittest.TestCase):
     def test_classify_en(self):
         project = TEST_EN_PROJECT.copy()
@@ -152,6 +654,28 @@ class TestClassifierResults(unittest.TestCase):
         results = classifier.classify(sample_texts)["model_scores"]
         assert round(results[0], 5) == 0.19358
 
+    @patch("processor.classifiers.embeddings_cache.get_cache", return_value=None)
+    def test_classify_ko_small_batches(self, mock_get_cache):
+        # micro-batching the embeddings shouldn't change the scores (the multilingual model works on any text, and
+        # the cache is off so every text really goes through the model)
+        project = TEST_EN_PROJECT.copy()
+        project["language_model_id"] = 17
+        project["language"] = classifiers.LANGUAGE_KO
+        classifier = classifiers.for_project(project)
+        with open(
+            os.path.join(test_fixture_dir, "more_sample_stories.json"), encoding="utf-8"
+        ) as f:
+            sample_texts = json.load(f)
+        sample_texts = [dict(story_text=t) for t in sample_texts]
+        assert len(sample_texts) > 1
+        with patch.object(classifiers, "EMBEDDINGS_BATCH_SIZE", 1):
+            one_at_a_time = classifier.classify(sample_texts)["model_scores"]
+        with patch.object(classifiers, "EMBEDDINGS_BATCH_SIZE", len(sample_texts)):
+            all_at_once = classifier.classify(sample_texts)["model_scores"]
+        assert len(one_at_a_time) == len(sample_texts)
+        for single, batched in zip(one_at_a_time, all_at_once):
+            self.assertAlmostEqual(single, batched, places=5)
+
     def test_stories_against_all_classifiers(self):
         results_by_model_id = self._classify_one_from(6, "more_sample_stories.json")
         assert round(results_by_model_id[0], 5) == 0.30392
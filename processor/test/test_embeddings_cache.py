@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from processor.embeddings_cache import EmbeddingsCache
+
+
+class TestEmbeddingsCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.cache = EmbeddingsCache(os.path.join(self._dir.name, "cache.db"))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_get_and_put(self):
+        texts = ["one story", "another story"]
+        assert self.cache.get_many("embeddings-en", texts) == [None, None]
+        vectors = np.array([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], dtype=np.float32)
+        self.cache.put_many("embeddings-en", texts, vectors)
+        found = self.cache.get_many("embeddings-en", ["another story", "new story"])
+        assert np.array_equal(found[0], vectors[1])
+        assert found[1] is None
+        # vectors are kept separate for each model
+        assert self.cache.get_many("embeddings-multi", texts) == [None, None]
+
+    def test_delete_older_than(self):
+        vectors = np.array([[0.1, 0.2, 0.3]], dtype=np.float32)
+        self.cache.put_many("embeddings-en", ["one story"], vectors)
+        assert self.cache.delete_older_than(1) == 0
+        assert self.cache.delete_older_than(-1) == 1
+        assert self.cache.get_many("embeddings-en", ["one story"]) == [None]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,25 @@
+import os
+import tempfile
+import time
 import unittest
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict
+from unittest.mock import patch
 
-from processor.fetcher import fetch_all_html, group_urls_by_domain
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from twisted.internet import defer, reactor, threads
+
+import processor.fetcher as fetcher
+from processor.fetcher import (
+    ContentExtractor,
+    NormalizedUrlCacheStorage,
+    fetch_all_html,
+    group_urls_by_domain,
+    iter_all_html,
+    prune_response_cache,
+)
 
 # random samples from our real database
 sample_urls = [
@@ -60,6 +78,25 @@ class TestUrlSpider(unittest.TestCase):
 
         fetch_all_html(sample_urls, handle_parse)
 
+    def test_fetch_all_html_repeatedly(self):
+        # the reactor isn't restartable, so make sure we can crawl in more than one batch per process
+        fetched_urls = []
+
+        def handle_parse(story: Dict):
+            fetched_urls.append(story["original_url"])
+
+        fetch_all_html(sample_urls[:5], handle_parse)
+        first_batch_count = len(fetched_urls)
+        fetch_all_html(sample_urls[5:10], handle_parse)
+        assert set(fetched_urls[:first_batch_count]) <= set(sample_urls[:5])
+        assert set(fetched_urls[first_batch_count:]) <= set(sample_urls[5:10])
+
+    def test_iter_all_html(self):
+        stories = list(iter_all_html(sample_urls[:5]))
+        for story in stories:
+            assert story["original_url"] in sample_urls[:5]
+            assert "content" in story
+
     def test_group_urls_by_domain(self):
         # Test Case 1 (w/ domain overlap)
         expected_output = [
@@ -121,5 +158,200 @@ class TestUrlSpider(unittest.TestCase):
         self.assertEqual(grouped_urls, expected_output)
 
 
+class _FakeCrawlerRunner:
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        return defer.succeed(None)
+
+
+def _fake_run_spider(handled_urls: list):
+    # "fetches" each URL right away, waiting on handle_parse like UrlSpider does
+    def run_spider(handle_parse, urls, extractor=None, runner=None):
+        async def crawl():
+            for url in urls:
+                if runner.stopped:
+                    break
+                await defer.maybeDeferred(handle_parse, dict(original_url=url))
+                handled_urls.append(url)
+
+        return defer.ensureDeferred(crawl())
+
+    return run_spider
+
+
+@patch.object(fetcher.crawler, "CrawlerRunner", _FakeCrawlerRunner)
+class TestIterAllHtml(unittest.TestCase):
+    def test_slows_down_for_caller(self):
+        urls = ["https://example.com/{}".format(i) for i in range(10)]
+        handled_urls = []
+        with patch.object(fetcher, "run_spider", _fake_run_spider(handled_urls)):
+            stories = iter_all_html(urls, num_spiders=1, max_waiting=2)
+            first_story = next(stories)
+            time.sleep(0.5)
+            # the one we have, and the two waiting for us
+            assert len(handled_urls) == 3
+            other_stories = list(stories)
+        assert [first_story] + other_stories == [dict(original_url=u) for u in urls]
+
+    def test_stopping_early(self):
+        urls = ["https://example.com/{}".format(i) for i in range(10)]
+        handled_urls = []
+        with patch.object(fetcher, "run_spider", _fake_run_spider(handled_urls)):
+            stories = iter_all_html(urls, num_spiders=1, max_waiting=2)
+            next(stories)
+            stories.close()
+            time.sleep(0.5)
+        # the crawl is stopped (rather than stuck waiting on us, or fetching the rest for nothing)
+        assert 0 < len(handled_urls) < len(urls)
+
+    def test_crawl_fails(self):
+        def broken_run_spider(handle_parse, urls, extractor=None, runner=None):
+            raise RuntimeError("couldn't start spider")
+
+        with patch.object(fetcher, "run_spider", broken_run_spider):
+            with self.assertRaises(RuntimeError):
+                list(iter_all_html(["https://example.com/1"]))
+
+
+def _crash_once(url: str, marker_path: str) -> str:
+    # kills the worker process the first time it is called for this marker (like the OOM killer would)
+    if not os.path.exists(marker_path):
+        open(marker_path, "w").close()
+        os._exit(1)
+    return "extracted {}".format(url)
+
+
+def _always_crash(url: str, content: str) -> str:
+    os._exit(1)
+
+
+class TestContentExtractor(unittest.TestCase):
+    def setUp(self):
+        fetcher._start_reactor()
+        self._temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _extract(self, extractor: ContentExtractor, url: str, content: str):
+        return threads.blockingCallFromThread(reactor, extractor.extract, url, content)
+
+    def test_recovers_from_dead_worker(self):
+        extractor = ContentExtractor(_crash_once, processes=2)
+        marker_path = os.path.join(self._temp_dir.name, "crashed")
+        try:
+            assert (
+                self._extract(extractor, "https://example.com/1", marker_path)
+                == "extracted https://example.com/1"
+            )
+            # and the new pool keeps working
+            assert (
+                self._extract(extractor, "https://example.com/2", marker_path)
+                == "extracted https://example.com/2"
+            )
+        finally:
+            extractor.shutdown()
+
+    def test_cancelled(self):
+        extractor = ContentExtractor(_crash_once, processes=1)
+        marker_path = os.path.join(self._temp_dir.name, "crashed")
+        open(marker_path, "w").close()
+        try:
+            with self.assertRaises(defer.CancelledError):
+                threads.blockingCallFromThread(
+                    reactor,
+                    extractor.extract,
+                    "https://example.com/1",
+                    marker_path,
+                    cancelled=lambda: True,
+                )
+            assert (
+                threads.blockingCallFromThread(
+                    reactor,
+                    extractor.extract,
+                    "https://example.com/1",
+                    marker_path,
+                    cancelled=lambda: False,
+                )
+                == "extracted https://example.com/1"
+            )
+        finally:
+            extractor.shutdown()
+
+    def test_workers_not_forked_from_threads(self):
+        # the reactor thread is already running here, so the workers must not be plain forks of this process
+        extractor = ContentExtractor(_crash_once, processes=1)
+        try:
+            assert extractor._executor._mp_context.get_start_method() != "fork"
+        finally:
+            extractor.shutdown()
+
+    def test_gives_up_after_one_retry(self):
+        extractor = ContentExtractor(_always_crash, processes=2)
+        try:
+            with self.assertRaises(BrokenProcessPool):
+                self._extract(extractor, "https://example.com/1", "<html></html>")
+        finally:
+            extractor.shutdown()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self._temp_dir.name
+        self.storage = NormalizedUrlCacheStorage(
+            Settings(
+                dict(
+                    HTTPCACHE_DIR=self.cache_dir,
+                    HTTPCACHE_EXPIRATION_SECS=0,
+                    HTTPCACHE_GZIP=True,
+                )
+            )
+        )
+        self.spider = Spider("urlspider")
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _store(self, url: str, body: bytes = b"<html>story</html>"):
+        request = Request(url)
+        response = HtmlResponse(url, body=body, headers={"Content-Type": "text/html"})
+        self.storage.store_response(self.spider, request, response)
+
+    def test_shared_by_normalized_url(self):
+        self._store("https://www.example.com/story/1")
+        cached = self.storage.retrieve_response(
+            self.spider, Request("http://example.com/story/1#comments")
+        )
+        assert cached is not None
+        assert cached.status == 200
+        assert cached.body == b"<html>story</html>"
+        assert (
+            self.storage.retrieve_response(
+                self.spider, Request("https://example.com/story/2")
+            )
+            is None
+        )
+
+    def test_prune_response_cache(self):
+        for i in range(3):
+            self._store("https://example.com/story/{}".format(i), b"x" * 1024 * 1024)
+        # make the first one look old
+        meta_path = os.path.join(
+            self.storage._get_request_path(
+                self.spider, Request("https://example.com/story/0")
+            ),
+            "pickled_meta",
+        )
+        old = time.time() - 10 * 24 * 60 * 60
+        os.utime(meta_path, (old, old))
+        assert prune_response_cache(self.cache_dir, 1024, 24 * 60 * 60) == 1
+        # and then make it fit under a size limit, dropping the oldest first
+        assert prune_response_cache(self.cache_dir, 0, 0) == 2
+
+
 if __name__ == "__main__":
     unittest.main()
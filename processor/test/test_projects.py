@@ -34,6 +34,28 @@ class TestProjects(unittest.TestCase):
         assert round(feminicide_probs[1], 5) == 0.32298
         assert round(feminicide_probs[2], 5) == 0.33297
 
+    def test_classify_project_batches(self):
+        with open(
+            os.path.join(test_fixture_dir, "usa_sample_stories.json"), encoding="utf-8"
+        ) as f:
+            sample_text = json.load(f)
+        sample_stories = [dict(story_text=t) for t in sample_text]
+        other_project = TEST_EN_PROJECT.copy()
+        other_project["id"] = 1
+        # two projects sharing the same model should get scored together, but split back out right
+        results = projects.classify_project_batches(
+            [
+                (TEST_EN_PROJECT.copy(), sample_stories[:1]),
+                (other_project, sample_stories[1:3]),
+            ]
+        )
+        assert len(results) == 2
+        assert len(results[0]["model_scores"]) == 1
+        assert round(results[0]["model_scores"][0], 5) == 0.36395
+        assert len(results[1]["model_scores"]) == 2
+        assert round(results[1]["model_scores"][0], 5) == 0.32298
+        assert round(results[1]["model_scores"][1], 5) == 0.33297
+
     def test_newscatcher_countries(self):
         project_list = projects.load_project_list(True)
         assert len(project_list) > 0
@@ -0,0 +1,106 @@
+import datetime as dt
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import processor.url_filter as url_filter
+from processor.url_filter import BloomFilter, ProjectUrlFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.01)
+        added = ["https://example.com/story/{}".format(i) for i in range(1000)]
+        for url in added:
+            bloom.add(url)
+        # never a false negative
+        for url in added:
+            assert url in bloom
+        # and only a few false positives
+        false_positives = len(
+            [i for i in range(10000) if "https://other.com/{}".format(i) in bloom]
+        )
+        assert false_positives < 300
+
+    def test_save_and_load(self):
+        url_filter = ProjectUrlFilter(
+            12, BloomFilter(1000, 0.01), 0, 0, dt.datetime.now()
+        )
+        url_filter.add(5, "https://example.com/one")
+        url_filter.add(9, "https://example.com/two")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "project-12.bloom")
+            url_filter.save(path)
+            loaded = ProjectUrlFilter.load(path)
+        assert loaded.project_id == 12
+        assert loaded.last_story_id == 9
+        assert loaded.count == 2
+        assert "https://example.com/one" in loaded.bloom
+        assert "https://example.com/three" not in loaded.bloom
+
+
+class TestRecentlyProcessedUrls(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._dir_patcher = patch.object(
+            url_filter, "URL_FILTER_DIR", self._temp_dir.name
+        )
+        self._dir_patcher.start()
+        url_filter.clear_filter_cache()
+
+    def tearDown(self):
+        url_filter.clear_filter_cache()
+        self._dir_patcher.stop()
+        self._temp_dir.cleanup()
+
+    @patch("processor.url_filter.stories_db")
+    def test_refresh_once_per_run(self, mock_stories_db):
+        project = dict(id=3)
+        session = MagicMock()
+        mock_stories_db.project_story_ids_and_normalized_urls.return_value = [
+            (1, "https://example.com/one"),
+            (2, "https://example.com/two"),
+        ]
+        mock_stories_db.project_story_normalized_urls.return_value = frozenset(
+            ["https://example.com/one"]
+        )
+        url_filter.refresh_filter(session, project, 14)
+        assert mock_stories_db.project_story_ids_and_normalized_urls.call_count == 1
+        # checking pages only goes to the database for the URLs that might have been seen
+        for page in range(3):
+            seen = url_filter.recently_processed_urls(
+                session,
+                project,
+                ["https://example.com/one", "https://example.com/new-{}".format(page)],
+                14,
+            )
+            assert seen == {"https://example.com/one"}
+            only_urls = mock_stories_db.project_story_normalized_urls.call_args[1][
+                "only_urls"
+            ]
+            assert only_urls == {"https://example.com/one"}
+        assert mock_stories_db.project_story_ids_and_normalized_urls.call_count == 1
+        # a page with no possible matches doesn't go to the database at all
+        calls = mock_stories_db.project_story_normalized_urls.call_count
+        assert (
+            url_filter.recently_processed_urls(
+                session, project, ["https://example.com/three"], 14
+            )
+            == set()
+        )
+        assert mock_stories_db.project_story_normalized_urls.call_count == calls
+
+    @patch("processor.url_filter.stories_db")
+    def test_no_filter_yet(self, mock_stories_db):
+        mock_stories_db.project_story_ids_and_normalized_urls.return_value = []
+        seen = url_filter.recently_processed_urls(
+            MagicMock(), dict(id=4), ["https://example.com/one"], 14
+        )
+        assert seen == set()
+        assert mock_stories_db.project_story_ids_and_normalized_urls.call_count == 1
+        assert os.path.exists(os.path.join(self._temp_dir.name, "project-4.bloom"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import datetime as dt
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+from typing import Dict, Iterable, Optional, Set
+
+from sqlalchemy.orm.session import Session
+
+import processor.database.stories_db as stories_db
+from processor import base_dir
+
+logger = logging.getLogger(__name__)
+
+# Before fetching text we check if we've already seen each story URL for the project. A Bloom filter per project
+# answers "definitely new" for most URLs without a trip to the database, so we only ask the database about the few
+# that might be duplicates. The filters are saved to disk and kept up to date from the stories table.
+URL_FILTER_DIR = os.environ.get(
+    "URL_FILTER_DIR", os.path.join(base_dir, "files", "url-filters")
+)
+URL_FILTER_ERROR_RATE = float(os.environ.get("URL_FILTER_ERROR_RATE", 0.001))
+MIN_URL_FILTER_CAPACITY = 100000
+
+# project id -> ProjectUrlFilter, so we don't re-read the file from disk for every page of results
+_project_filters: Dict[int, "ProjectUrlFilter"] = {}
+_project_filters_lock = threading.Lock()
+
+
+class BloomFilter:
+    """
+    A set of strings that can have false positives (at about `error_rate` when filled to `capacity`), but never false
+    negatives. Uses much less memory than a real set of URLs.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, bits: bytearray = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = int(
+            math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, item: str):
+        # double hashing from one digest, rather than computing k separate hashes
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class ProjectUrlFilter:
+    """
+    The normalized URLs of stories we've queued for one project, up to and including the story with `last_story_id`.
+    """
+
+    def __init__(
+        self,
+        project_id: int,
+        bloom: BloomFilter,
+        last_story_id: int,
+        count: int,
+        built_at: dt.datetime,
+    ):
+        self.project_id = project_id
+        self.bloom = bloom
+        self.last_story_id = last_story_id
+        self.count = count
+        self.built_at = built_at
+
+    def add(self, story_id: int, normalized_url: str) -> None:
+        self.bloom.add(normalized_url)
+        self.last_story_id = max(self.last_story_id, story_id)
+        self.count += 1
+
+    def is_full(self) -> bool:
+        return self.count > self.bloom.capacity
+
+    def save(self, path: str) -> None:
+        header = dict(
+            project_id=self.project_id,
+            capacity=self.bloom.capacity,
+            error_rate=self.bloom.error_rate,
+            last_story_id=self.last_story_id,
+            count=self.count,
+            built_at=self.built_at.isoformat(),
+        )
+        # write to a temp file and rename it, so another process never reads a half-written filter
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(self.bloom.bits)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def load(path: str) -> "ProjectUrlFilter":
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            bits = bytearray(f.read())
+        bloom = BloomFilter(header["capacity"], header["error_rate"], bits)
+        if len(bits) != len(bloom.bits):
+            raise ValueError("Bloom filter file {} is truncated".format(path))
+        return ProjectUrlFilter(
+            header["project_id"],
+            bloom,
+            header["last_story_id"],
+            header["count"],
+            dt.datetime.fromisoformat(header["built_at"]),
+        )
+
+
+def _filter_path(project_id: int) -> str:
+    return os.path.join(URL_FILTER_DIR, "project-{}.bloom".format(project_id))
+
+
+def _build_filter(
+    session: Session, project: Dict, last_n_days: int, capacity: int
+) -> ProjectUrlFilter:
+    url_filter = ProjectUrlFilter(
+        project["id"],
+        BloomFilter(capacity, URL_FILTER_ERROR_RATE),
+        0,
+        0,
+        dt.datetime.now(),
+    )
+    stories = stories_db.project_story_ids_and_normalized_urls(
+        session, project, last_n_days=last_n_days
+    )
+    for story_id, normalized_url in stories:
+        url_filter.add(story_id, normalized_url)
+    return url_filter
+
+
+def _up_to_date_filter(
+    session: Session, project: Dict, last_n_days: int
+) -> ProjectUrlFilter:
+    """
+    Load the filter for this project (from memory or disk), add any stories that have been queued since it was last
+    updated, and save it. It is rebuilt from scratch if it is older than `last_n_days` (so it doesn't keep growing
+    forever) or has more URLs than it was sized for (so the false positive rate stays low).
+    """
+    path = _filter_path(project["id"])
+    url_filter = _project_filters.get(project["id"])
+    if (url_filter is None) and os.path.exists(path):
+        try:
+            url_filter = ProjectUrlFilter.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Can't load URL filter from {}: {}".format(path, e))
+    if (url_filter is not None) and (
+        url_filter.built_at < dt.datetime.now() - dt.timedelta(days=last_n_days)
+    ):
+        url_filter = None
+    added_count = 0
+    if url_filter is not None:
+        new_stories = stories_db.project_story_ids_and_normalized_urls(
+            session, project, since_id=url_filter.last_story_id, last_n_days=last_n_days
+        )
+        for story_id, normalized_url in new_stories:
+            url_filter.add(story_id, normalized_url)
+            added_count += 1
+    if (url_filter is None) or url_filter.is_full():
+        capacity = MIN_URL_FILTER_CAPACITY
+        if url_filter is not None:
+            capacity = max(capacity, url_filter.count * 2)
+        url_filter = _build_filter(session, project, last_n_days, capacity)
+        added_count = url_filter.count
+        logger.info(
+            "  Built URL filter for project {} with {} URLs".format(
+                project["id"], url_filter.count
+            )
+        )
+    if (added_count > 0) or not os.path.exists(path):
+        os.makedirs(URL_FILTER_DIR, exist_ok=True)
+        url_filter.save(path)
+    _project_filters[project["id"]] = url_filter
+    return url_filter
+
+
+def refresh_filter(session: Session, project: Dict, last_n_days: int) -> None:
+    """
+    Bring the project's filter up to date with the stories table. Call this once per project per run, before paging
+    through results, so checking each page doesn't need to query for newly queued stories.
+    :param session:
+    :param project:
+    :param last_n_days:
+    """
+    with _project_filters_lock:
+        _up_to_date_filter(session, project, last_n_days)
+
+
+def recently_processed_urls(
+    session: Session, project: Dict, normalized_urls: Iterable[str], last_n_days: int
+) -> Set[str]:
+    """
+    Which of these URLs have we already processed for this project in the last N days? Only the URLs the project's
+    Bloom filter says we might have seen are checked against the database. The filter isn't updated here (see
+    `refresh_filter`), unless there isn't one in memory yet.
+    :param session:
+    :param project:
+    :param normalized_urls:
+    :param last_n_days:
+    :return: the subset of `normalized_urls` that were already processed
+    """
+    with _project_filters_lock:
+        url_filter = _project_filters.get(project["id"])
+        if url_filter is None:
+            url_filter = _up_to_date_filter(session, project, last_n_days)
+    candidates = set(u for u in normalized_urls if u in url_filter.bloom)
+    if len(candidates) == 0:
+        return set()
+    return set(
+        stories_db.project_story_normalized_urls(
+            session, project, last_n_days, only_urls=candidates
+        )
+    )
+
+
+def clear_filter_cache(project_id: Optional[int] = None) -> None:
+    """
+    Forget the in-memory copy of the filters (for one project, or all of them).
+    """
+    with _project_filters_lock:
+        if project_id is None:
+            _project_filters.clear()
+        else:
+            _project_filters.pop(project_id, None)
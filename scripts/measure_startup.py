@@ -0,0 +1,57 @@
+"""
+Measure how long each of our entry points takes to import, and whether it pulls in TensorFlow. Each one is timed in a
+fresh Python process so nothing is already cached. Run it with `python -m scripts.measure_startup`.
+"""
+
+import subprocess
+import sys
+from typing import List, Tuple
+
+# what each of the run-*.sh scripts ends up importing before it starts real work
+ENTRY_POINTS = {
+    "run-fetch-mediacloud.sh": ["scripts.queue_mediacloud_stories"],
+    "run-fetch-newscatcher.sh": ["scripts.queue_newscatcher_stories"],
+    "run-fetch-wayback.sh": ["scripts.queue_wayback_stories"],
+    # celery loads the app and then all the task modules it includes
+    "run-beat.sh": ["processor.celery", "processor.tasks.delete_old_data"],
+    "run-workers.sh": [
+        "processor.celery",
+        "processor.tasks",
+        "processor.tasks.classification",
+        "processor.tasks.alerts",
+        "processor.tasks.delete_old_data",
+    ],
+}
+
+TIMING_CODE = """
+import sys, time
+start = time.perf_counter()
+for module_name in sys.argv[1:]:
+    __import__(module_name)
+print("{:.2f} {}".format(time.perf_counter() - start, "tensorflow" in sys.modules))
+"""
+
+
+def measure(modules: List[str]) -> Tuple[float, bool]:
+    """
+    :return: seconds to import, and whether tensorflow was imported along the way
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", TIMING_CODE] + modules,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().split("\n")[-1])
+    secs, loaded_tensorflow = result.stdout.strip().split("\n")[-1].split(" ")
+    return float(secs), loaded_tensorflow == "True"
+
+
+if __name__ == "__main__":
+    print("{:<26} {:>8}  {}".format("entry point", "secs", "tensorflow imported?"))
+    for name, modules in ENTRY_POINTS.items():
+        try:
+            secs, loaded_tensorflow = measure(modules)
+            print("{:<26} {:>8.2f}  {}".format(name, secs, loaded_tensorflow))
+        except RuntimeError as e:
+            print("{:<26} {:>8}  failed to import ({})".format(name, "-", e))
@@ -1,12 +1,13 @@
 # ruff: noqa: E402
 
+import collections
 import datetime as dt
 import itertools
 import logging
 import math
 import sys
 import time
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 import dateparser
 
@@ -20,9 +21,9 @@ import mcmetadata.urls as urls
 
 import processor.database as database
 import processor.database.projects_db as projects_db
-import processor.database.stories_db as stories_db
 import processor.fetcher as fetcher
 import processor.projects as projects
+import processor.url_filter as url_filter
 import scripts.newscatcher_api as newscatcher_api
 import scripts.tasks as tasks
 from processor.classifiers import download_models
@@ -113,12 +114,9 @@ def _project_story_worker(p: Dict) -> List[Dict]:
     project_stories = []
     skipped_dupes = 0  # how many URLs do we filter out because they're already in the DB for this project recently
     if total_hits > 0:
-        # list recent urls to filter so we don't fetch text extra if we've recently proceses already
-        # (and will be filtered out by add_stories call in later post-text-fetch step)
+        # catch the URL filter up with the stories table once, so each page is checked without querying for that
         with db_session_maker() as db_session:
-            already_processed_normalized_urls = (
-                stories_db.project_story_normalized_urls(db_session, p, 14)
-            )
+            url_filter.refresh_filter(db_session, p, 14)
         # query page by page
         latest_pub_date = dt.datetime.now() - dt.timedelta(weeks=50)
         page_count = math.ceil(total_hits / PAGE_SIZE)
@@ -134,13 +132,22 @@ def _project_story_worker(p: Dict) -> List[Dict]:
                 dateparser.parse(s["published_date"]) for s in current_page["articles"]
             ]
             latest_pub_date = max(latest_pub_date, max(page_latest_pub_date))
+            # check for urls we've recently processed already, so we don't fetch text extra
+            # (they would be filtered out by add_stories call in later post-text-fetch step)
+            normalized_urls = [
+                urls.normalize_url(item["link"]) for item in current_page["articles"]
+            ]
+            with db_session_maker() as db_session:
+                already_processed_normalized_urls = url_filter.recently_processed_urls(
+                    db_session, p, normalized_urls, 14
+                )
             # prep all the articles
-            for item in current_page["articles"]:
+            for item, normalized_url in zip(current_page["articles"], normalized_urls):
                 if len(project_stories) > MAX_STORIES_PER_PROJECT:
                     break
                 real_url = item["link"]
                 # skip URLs we've processed recently
-                if urls.normalize_url(real_url) in already_processed_normalized_urls:
+                if normalized_url in already_processed_normalized_urls:
                     skipped_dupes += 1
                     continue
                 # removing this check for now, because I'm not sure if stories are ordered consistently
@@ -206,35 +213,41 @@ def fetch_project_stories(project_list: List[Dict]) -> List[Dict]:
     return combined_stories
 
 
-def fetch_text(stories: List[Dict]) -> List[Dict]:
-    stories_to_return = []
-
-    def handle_parse(response_data: Dict):
-        # called for each story that successfully is fetched by Scrapy
-        nonlocal stories, stories_to_return
-        matching_input_stories = [
-            s for s in stories if s["url"] == response_data["original_url"]
-        ]
-        for (
-            s
-        ) in (
-            matching_input_stories
-        ):  # find all matches, which could be from different projects
-            story_metadata = metadata.extract(s["url"], response_data["content"])
+def fetch_text(stories: List[Dict]) -> Iterator[Dict]:
+    """
+    Yields each story with its text (and publish date) filled in as soon as its page has been fetched and parsed,
+    dropping stories that fail. Only the returned iterator holds on to the stories, until each one is yielded.
+    """
+    # the same URL can be found by different projects, so index them up front to match responses quickly
+    stories_by_url = collections.defaultdict(list)
+    for s in stories:
+        stories_by_url[s["url"]].append(s)
+    return _stories_with_text(stories_by_url, len(stories))
+
+
+def _stories_with_text(
+    stories_by_url: Dict[str, List[Dict]], story_count: int
+) -> Iterator[Dict]:
+    stories_with_text_count = 0
+    # download them all in parallel... will take a while (make it only unique URLs first); the HTML is parsed in
+    # worker processes as pages come in
+    for response_data in fetcher.iter_all_html(
+        list(stories_by_url.keys()), extract=metadata.extract
+    ):
+        story_metadata = response_data["extracted"]
+        # update all matches, which could be from different projects (and forget about them once they're passed on)
+        for s in stories_by_url.pop(response_data["original_url"], []):
             s["story_text"] = story_metadata["text_content"]
             s["publish_date"] = story_metadata[
                 "publication_date"
             ]  # this is a date object
-            stories_to_return.append(s)
-
-    # download them all in parallel... will take a while (make it only unique URLs first)
-    fetcher.fetch_all_html(list(set([s["url"] for s in stories])), handle_parse)
+            stories_with_text_count += 1
+            yield s
     logger.info(
         "Fetched text for {} stories (failed on {})".format(
-            len(stories_to_return), len(stories) - len(stories_to_return)
+            stories_with_text_count, story_count - stories_with_text_count
         )
     )
-    return stories_to_return
 
 
 if __name__ == "__main__":
@@ -261,19 +274,22 @@ if __name__ == "__main__":
         )
     )
 
-    # 3. fetch webpage text and parse all the stories (use scrapy to do this in parallel, dropping stories that fail)
+    # make room in the page cache before we add more to it
+    fetcher.prune_response_cache()
+
+    # 3. fetch webpage text and parse all the stories (use scrapy to do this in parallel, dropping stories that fail),
+    # 4. and post batches of stories for classification as they come in
     stories_with_text = fetch_text(all_stories)
+    del all_stories  # so each story can be freed once it has been queued
+    results_data = tasks.queue_stories_for_classification(
+        projects_list, stories_with_text, processor.SOURCE_NEWSCATCHER
+    )
     logger.info(
         "Fetched {} stories with text, from {} attempted URLs".format(
-            len(stories_with_text), unique_url_count
+            results_data["stories"], unique_url_count
         )
     )
 
-    # 4. post batches of stories for classification
-    results_data = tasks.queue_stories_for_classification(
-        projects_list, stories_with_text, processor.SOURCE_NEWSCATCHER
-    )
-
     # 5. send email/slack_msg with results of operations
     tasks.send_combined_slack_message(
         results_data, processor.SOURCE_NEWSCATCHER, start_time
@@ -1,5 +1,6 @@
 # ruff: noqa: E402
 
+import collections
 import datetime as dt
 import itertools
 import json
@@ -7,7 +8,7 @@ import logging
 import sys
 import time
 from multiprocessing import Pool
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 # Disable loggers prior to package imports
 import processor
@@ -19,10 +20,10 @@ from mc_providers.onlinenews import OnlineNewsWaybackMachineProvider
 
 import processor.database as database
 import processor.database.projects_db as projects_db
-import processor.database.stories_db as stories_db
 import processor.fetcher as fetcher
 import processor.mcdirectory as mcdirectory
 import processor.projects as projects
+import processor.url_filter as url_filter
 import scripts.tasks as tasks
 from processor.classifiers import download_models
 
@@ -79,12 +80,9 @@ def _project_story_worker(p: Dict) -> List[Dict]:
             )
         )
         if total_hits > 0:  # don't bother querying if no results to page through
-            # list recent urls to filter so we don't fetch text extra if we've recently proceses already (and will be
-            # filtered out by add_stories call in later post-text-fetch step)
+            # catch the URL filter up with the stories table once, so each page is checked without querying for that
             with Session() as session:
-                already_processed_urls = stories_db.project_story_normalized_urls(
-                    session, p, 14
-                )
+                url_filter.refresh_filter(session, p, 14)
             # using the provider wrapper so this does the chunking into smaller queries for us
             latest_pub_date = dt.datetime.now() - dt.timedelta(weeks=50)
             for page in wm_provider.all_items(
@@ -107,12 +105,19 @@ def _project_story_worker(p: Dict) -> List[Dict]:
                     # can't track `capture_time` here because it isn't returned in results
                 except Exception:  # maybe no stories on this page?
                     pass
+                # check for urls we've recently processed already, so we don't fetch text extra (they would be
+                # filtered out by add_stories call in later post-text-fetch step)
+                normalized_urls = [urls.normalize_url(item["url"]) for item in page]
+                with Session() as session:
+                    already_processed_urls = url_filter.recently_processed_urls(
+                        session, p, normalized_urls, 14
+                    )
                 # prep all stories
-                for item in page:
+                for item, normalized_url in zip(page, normalized_urls):
                     if len(project_stories) > MAX_STORIES_PER_PROJECT:
                         break
                     # skip URLs we've processed recently
-                    if urls.normalize_url(item["url"]) in already_processed_urls:
+                    if normalized_url in already_processed_urls:
                         skipped_dupes += 1
                         continue
                     info = dict(
@@ -175,40 +180,44 @@ def fetch_project_stories(project_list: List[Dict]) -> List[Dict]:
     return combined_stories
 
 
-def fetch_text(stories: List[Dict]) -> List[Dict]:
-    stories_to_return = []
+def fetch_text(stories: List[Dict]) -> Iterator[Dict]:
+    """
+    Yields each story with its text filled in as soon as it has been fetched, dropping stories that fail. Only the
+    returned iterator holds on to the stories, until each one is yielded.
+    """
+    # match stories in the original input list based on `extracted_content_url`, because we are fetching from that and
+    # not he actual story URL (index them up front so each response is matched quickly)
+    stories_by_content_url = collections.defaultdict(list)
+    for s in stories:
+        stories_by_content_url[s["extracted_content_url"]].append(s)
+    return _stories_with_text(stories_by_content_url, len(stories))
+
 
-    def handle_parse(response_data: Dict):
-        # called for each story that successfully is fetched by Scrapy
-        nonlocal stories, stories_to_return
+def _stories_with_text(
+    stories_by_content_url: Dict[str, List[Dict]], story_count: int
+) -> Iterator[Dict]:
+    stories_with_text_count = 0
+    # download them all in parallel... will take a while (note that we're fetching the extracted content JSON here,
+    # NOT the archived or original HTML because that saves us the parsing and extraction step)
+    for response_data in fetcher.iter_all_html(list(stories_by_content_url.keys())):
         try:
             story_details = json.loads(response_data["content"])
-            # find matching stories in the original input list based on `extracted_content_url`, because we are
-            # fetching from that and not he actual story URL
-            matching_input_stories = [
-                s
-                for s in stories
-                if s["extracted_content_url"] == response_data["original_url"]
-            ]
-            for s in matching_input_stories:
-                s["story_text"] = story_details["snippet"]
-                stories_to_return.append(s)
         except Exception as e:
             # this just happens occasionally so it is a normal case
             logger.warning(
                 f"Skipping story - failed to fetch due to {e} - from {response_data['original_url']}"
             )
-
-    # download them all in parallel... will take a while (note that we're fetching the extracted content JSON here,
-    # NOT the archived or original HTML because that saves us the parsing and extraction step)
-    unique_urls = list(set([s["extracted_content_url"] for s in stories]))
-    fetcher.fetch_all_html(unique_urls, handle_parse)
+            continue
+        # forget about the stories once they're passed on
+        for s in stories_by_content_url.pop(response_data["original_url"], []):
+            s["story_text"] = story_details["snippet"]
+            stories_with_text_count += 1
+            yield s
     logger.info(
         "Fetched text for {} stories (failed on {})".format(
-            len(stories_to_return), len(stories) - len(stories_to_return)
+            stories_with_text_count, story_count - stories_with_text_count
         )
     )
-    return stories_to_return
 
 
 if __name__ == "__main__":
@@ -241,19 +250,22 @@ if __name__ == "__main__":
         )
     )
 
-    # 4. fetch pre-parsed content (will happen in parallel by story)
+    # make room in the page cache before we add more to it
+    fetcher.prune_response_cache()
+
+    # 4. fetch pre-parsed content (will happen in parallel by story),
+    # 5. and post batches of stories for classification as they come in
     stories_with_text = fetch_text(all_stories)
+    del all_stories  # so each story can be freed once it has been queued
+    results_data = tasks.queue_stories_for_classification(
+        projects_list, stories_with_text, processor.SOURCE_WAYBACK_MACHINE
+    )
     logger.info(
         "Fetched {} stories with text, from {} attempted URLs".format(
-            len(stories_with_text), unique_url_count
+            results_data["stories"], unique_url_count
         )
     )
 
-    # 5. post batches of stories for classification
-    results_data = tasks.queue_stories_for_classification(
-        projects_list, stories_with_text, processor.SOURCE_WAYBACK_MACHINE
-    )
-
     # 6. send email/slack_msg with results of operations
     tasks.send_combined_slack_message(
         results_data, processor.SOURCE_WAYBACK_MACHINE, start_time
@@ -1,6 +1,10 @@
+import collections
+import datetime as dt
+import json
 import logging
+import os
 import time
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import dateutil.parser
 
@@ -13,6 +17,13 @@ from processor.database import stories_db as stories_db
 
 logger = logging.getLogger(__name__)
 
+# stories from projects sharing a model get queued together, up to this many per task
+MAX_STORIES_PER_TASK = 1000
+# and up to about this much JSON, so each message stays well under the broker's max message size
+MAX_TASK_PAYLOAD_BYTES = int(os.environ.get("MAX_TASK_PAYLOAD_BYTES", 16 * 1024 * 1024))
+# when stories are streamed in, queue up the ones for a model once about this many have arrived
+STREAMED_STORIES_PER_BATCH = 200
+
 
 def send_combined_email(summary: Dict, data_source: str, start_time: float):
     email_message = _get_combined_text(
@@ -113,55 +124,179 @@ def _send_slack_message(
 
 
 def queue_stories_for_classification(
-    project_list: List[Dict], stories: List[Dict], datasource: str
+    project_list: List[Dict],
+    stories: Iterable[Dict],
+    datasource: str,
+    batch_size: int = STREAMED_STORIES_PER_BATCH,
 ) -> Dict:
-    total_stories = 0
+    """
+    Log stories in the database and queue the new ones up for classification. Stories can arrive over time (ie. as
+    they are fetched); they are logged and queued as soon as `batch_size` of them have arrived for projects sharing a
+    model, so classification can start before the fetching is done and we don't hold on to all the story text.
+    """
+    projects_by_id = {p["id"]: p for p in project_list}
+    story_counts = collections.Counter()  # by project id
+    # stories that haven't been queued yet, by model and then by project
+    pending_stories = collections.defaultdict(lambda: collections.defaultdict(list))
+    pending_counts = collections.Counter()  # by model
+    latest_dates = (
+        {}
+    )  # by project id, so later batches don't move the project history back
+    Session = database.get_session_maker()
+
+    def queue_pending(model_key: Tuple):
+        stories_to_queue = []
+        for project_id, project_stories in pending_stories.pop(model_key).items():
+            p = projects_by_id[project_id]
+            project_stories = _add_project_stories(
+                Session, p, project_stories, datasource
+            )
+            if len(project_stories) > 0:
+                stories_to_queue.append((p, project_stories))
+        del pending_counts[model_key]
+        _queue_batches_by_model(stories_to_queue, datasource, latest_dates)
+
+    for s in stories:
+        if (s is None) or (s["project_id"] not in projects_by_id):
+            continue
+        p = projects_by_id[s["project_id"]]
+        model_key = (p["language_model_id"], p["language"])
+        pending_stories[model_key][p["id"]].append(s)
+        pending_counts[model_key] += 1
+        story_counts[p["id"]] += 1
+        if pending_counts[model_key] >= batch_size:
+            queue_pending(model_key)
+    for model_key in list(pending_stories.keys()):
+        queue_pending(model_key)
+
     email_message = ""
     for p in project_list:
-        project_stories = [
-            s for s in stories if (s is not None) and (s["project_id"] == p["id"])
-        ]
         email_message += "Project {} - {}: {} stories\n".format(
-            p["id"], p["title"], len(project_stories)
+            p["id"], p["title"], story_counts[p["id"]]
+        )
+    return dict(
+        email_text=email_message,
+        project_count=len(project_list),
+        stories=sum(story_counts.values()),
+    )
+
+
+def _add_project_stories(
+    Session, p: Dict, project_stories: List[Dict], datasource: str
+) -> List[Dict]:
+    """Logs the stories in the database, returning the ones that are new (and so need to be classified)"""
+    # External source has guessed dates (Newscatcher/Google), so use that
+    for s in project_stories:
+        if "source_publish_date" in s:
+            s["publish_date"] = s["source_publish_date"]
+    # and log that we got them all
+    try:
+        with Session() as session:
+            return stories_db.add_stories(session, project_stories, p, datasource)
+    except Exception as e:
+        logger.warning("Couldn't log stories for project {}: {}".format(p["id"], e))
+        return []
+
+
+def _queue_batches_by_model(
+    stories_to_queue: List[Tuple[Dict, List[Dict]]],
+    datasource: str,
+    latest_dates: Optional[Dict[int, dt.datetime]] = None,
+) -> None:
+    """
+    Projects that share a model get queued together in the same classification task, so the worker can vectorize and
+    score all their stories in one pass.
+    :param latest_dates: latest publish date queued so far per project id, when queueing more than once per run
+    """
+    projects_by_model = collections.defaultdict(list)
+    for p, project_stories in stories_to_queue:
+        projects_by_model[(p["language_model_id"], p["language"])].append(
+            (p, project_stories)
         )
-        total_stories += len(project_stories)
-        if len(project_stories) > 0:
-            # External source has guessed dates (Newscatcher/Google), so use that
+    for model_stories_to_queue in projects_by_model.values():
+        # but keep each task small enough to make it through the queue (splitting up a project's stories if needed)
+        task_batch = []
+        task_story_count = 0
+        task_payload_size = 0
+        for p, project_stories in model_stories_to_queue:
+            task_stories = []
+            task_batch.append((p, task_stories))
             for s in project_stories:
-                if "source_publish_date" in s:
-                    s["publish_date"] = s["source_publish_date"]
-            # and log that we got and queued them all (this might happen a loooooong time after we last used the DB,
-            # so lets be careful here and reset the engine before using the session)
+                story_size = _story_payload_size(s)
+                if (task_story_count > 0) and (
+                    (task_story_count >= MAX_STORIES_PER_TASK)
+                    or (task_payload_size + story_size > MAX_TASK_PAYLOAD_BYTES)
+                ):
+                    _queue_batch(task_batch, datasource, latest_dates)
+                    task_stories = []
+                    task_batch = [(p, task_stories)]
+                    task_story_count = 0
+                    task_payload_size = 0
+                task_stories.append(s)
+                task_story_count += 1
+                task_payload_size += story_size
+        if task_story_count > 0:
+            _queue_batch(task_batch, datasource, latest_dates)
+
+
+def _story_payload_size(story: Dict) -> int:
+    # roughly how big the story will be in the task message (dates and such go in as strings)
+    return len(json.dumps(story, default=str))
+
+
+def _queue_batch(
+    task_batch: List[Tuple[Dict, List[Dict]]],
+    datasource: str,
+    latest_dates: Optional[Dict[int, dt.datetime]] = None,
+) -> None:
+    task_batch = [
+        (p, project_stories) for p, project_stories in task_batch if project_stories
+    ]
+    if len(task_batch) == 0:
+        return
+    try:
+        classification_tasks.classify_and_post_batch_worker.delay(
+            [
+                dict(project=p, stories=project_stories)
+                for p, project_stories in task_batch
+            ]
+        )
+        queued_batch = task_batch
+    except Exception as e:
+        # could be amqp.exceptions.PreconditionFailed if message it too big; the stories are already in the database
+        # so they won't be queued again tomorrow, which means trying each project on its own instead of dropping them
+        logger.warning(
+            "Couldn't queue {} projects together, queueing them one at a time: {}".format(
+                len(task_batch), e
+            )
+        )
+        queued_batch = []
+        for p, project_stories in task_batch:
             try:
-                Session = database.get_session_maker(reset_pool=True)
-                with Session() as session:
-                    project_stories = stories_db.add_stories(
-                        session, project_stories, p, datasource
-                    )
-                    if len(project_stories) > 0:  # don't queue up unnecessary tasks
-                        classification_tasks.classify_and_post_worker.delay(
-                            p, project_stories
-                        )
-                        # important to write this update now, because we have queued up the task to process these
-                        # stories the task queue will manage retrying with the stories if it fails with this batch
-                        publish_dates = [
-                            dateutil.parser.parse(s["source_publish_date"])
-                            for s in project_stories
-                        ]
-                        latest_date = max(
-                            publish_dates
-                        )  # we use latest pub_date to filter in our queries tomorrow
-                        projects_db.update_history(
-                            session, p["id"], latest_date, datasource
-                        )
-                logger.info(
-                    "  queued {} stories for project {}/{}".format(
-                        len(project_stories), p["id"], p["title"]
+                classification_tasks.classify_and_post_worker.delay(p, project_stories)
+                queued_batch.append((p, project_stories))
+            except Exception as e:
+                logger.warning(
+                    "Too big for celery, skipping {} stories for project {}: {}".format(
+                        len(project_stories), p["id"], e
                     )
                 )
-            except Exception as e:
-                # could be amqp.exceptions.PreconditionFailed if message it too big, just skip it
-                logger.warning("Too big for celery, skipping: {}".format(e))
-    return dict(
-        email_text=email_message, project_count=len(project_list), stories=total_stories
-    )
+    # important to write this update now, because we have queued up the task to process these stories the task
+    # queue will manage retrying with the stories if it fails with this batch
+    Session = database.get_session_maker()
+    with Session() as session:
+        for p, project_stories in queued_batch:
+            publish_dates = [
+                dateutil.parser.parse(s["source_publish_date"]) for s in project_stories
+            ]
+            # we use latest pub_date to filter in our queries tomorrow
+            latest_date = max(publish_dates)
+            if latest_dates is not None:
+                latest_date = max(latest_date, latest_dates.get(p["id"], latest_date))
+                latest_dates[p["id"]] = latest_date
+            projects_db.update_history(session, p["id"], latest_date, datasource)
+            logger.info(
+                "  queued {} stories for project {}/{}".format(
+                    len(project_stories), p["id"], p["title"]
+                )
+            )
@@ -0,0 +1,74 @@
+import unittest
+from unittest.mock import patch
+
+import scripts.tasks as tasks
+
+PROJECT_1 = dict(id=1, title="one", language="en", language_model_id=3)
+PROJECT_2 = dict(id=2, title="two", language="en", language_model_id=3)
+
+
+def _stories(count: int, text_length: int = 10):
+    return [
+        dict(
+            url="https://example.com/{}".format(i),
+            story_text="x" * text_length,
+            source_publish_date="2024-01-0{}".format(1 + (i % 9)),
+        )
+        for i in range(count)
+    ]
+
+
+class TestQueueBatchesByModel(unittest.TestCase):
+    @patch("scripts.tasks._queue_batch")
+    def test_split_by_count(self, mock_queue_batch):
+        with patch.object(tasks, "MAX_STORIES_PER_TASK", 4):
+            tasks._queue_batches_by_model(
+                [(PROJECT_1, _stories(3)), (PROJECT_2, _stories(3))], "test"
+            )
+        batches = [c[0][0] for c in mock_queue_batch.call_args_list]
+        assert [[(p["id"], len(s)) for p, s in b] for b in batches] == [
+            [(1, 3), (2, 1)],
+            [(2, 2)],
+        ]
+
+    @patch("scripts.tasks._queue_batch")
+    def test_split_by_payload_size(self, mock_queue_batch):
+        stories = _stories(5, text_length=1000)
+        with patch.object(tasks, "MAX_TASK_PAYLOAD_BYTES", 2500):
+            tasks._queue_batches_by_model([(PROJECT_1, stories)], "test")
+        batches = [c[0][0] for c in mock_queue_batch.call_args_list]
+        assert [len(b[0][1]) for b in batches] == [2, 2, 1]
+        for b in batches:
+            assert sum(tasks._story_payload_size(s) for s in b[0][1]) <= 2500
+
+
+class TestQueueBatch(unittest.TestCase):
+    @patch("scripts.tasks.projects_db")
+    @patch("scripts.tasks.database")
+    @patch("scripts.tasks.classification_tasks")
+    def test_falls_back_to_each_project(
+        self, mock_classification_tasks, mock_database, mock_projects_db
+    ):
+        mock_classification_tasks.classify_and_post_batch_worker.delay.side_effect = (
+            RuntimeError("message too big")
+        )
+        # the first project still fails on its own, but the second one makes it
+        mock_classification_tasks.classify_and_post_worker.delay.side_effect = [
+            RuntimeError("message too big"),
+            None,
+        ]
+        project_2_stories = _stories(2)
+        tasks._queue_batch(
+            [(PROJECT_1, _stories(3)), (PROJECT_2, project_2_stories)], "test"
+        )
+        assert mock_classification_tasks.classify_and_post_worker.delay.call_count == 2
+        mock_classification_tasks.classify_and_post_worker.delay.assert_called_with(
+            PROJECT_2, project_2_stories
+        )
+        # only the queued project's history moves forward
+        assert mock_projects_db.update_history.call_count == 1
+        assert mock_projects_db.update_history.call_args[0][1] == PROJECT_2["id"]
+
+
+if __name__ == "__main__":
+    unittest.main()